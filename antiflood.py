@@ -0,0 +1,76 @@
+import functools
+import time
+from collections import OrderedDict
+
+# Tap ripetuti sullo stesso pulsante entro questa finestra (secondi) vengono ignorati
+DEBOUNCE_WINDOW = 2.0
+
+class CallbackGuard:
+    """Protezione anti-flood per gli handler dei pulsanti inline
+
+    Per ogni coppia (utente, callback_data) esegue l'handler una sola volta:
+    i tap che arrivano mentre è ancora in esecuzione, o entro `window`
+    secondi dall'ultima esecuzione, ricevono solo la risposta alla callback
+    (per fermare la rotellina del client) e vengono scartati.
+
+    Con debounce=False si scartano solo i tap che arrivano durante
+    l'esecuzione: serve per i pulsanti che l'utente ripete di proposito
+    (es. PARTECIPA dopo essersi iscritto al canale).
+    """
+
+    def __init__(self, window=DEBOUNCE_WINDOW):
+        self.window = window
+        self._in_flight = set()
+        self._last_run = OrderedDict()   # chiave -> fine ultima esecuzione
+        self.counters = {'executed': 0, 'in_flight': 0, 'debounced': 0}
+
+    def _recently_run(self, key, now):
+        # Le chiavi sono in ordine di esecuzione: scarta quelle fuori finestra
+        while self._last_run:
+            finished_at = next(iter(self._last_run.values()))
+            if now - finished_at < self.window:
+                break
+            self._last_run.popitem(last=False)
+        return key in self._last_run
+
+    def __call__(self, handler, debounce=True):
+        @functools.wraps(handler)
+        async def guarded(update, context):
+            query = update.callback_query
+            key = (query.from_user.id, query.data)
+
+            if key in self._in_flight:
+                self.counters['in_flight'] += 1
+                await query.answer()
+                return
+            if debounce and self._recently_run(key, time.monotonic()):
+                self.counters['debounced'] += 1
+                await query.answer()
+                return
+
+            self._in_flight.add(key)
+            self.counters['executed'] += 1
+            try:
+                return await handler(update, context)
+            finally:
+                self._in_flight.discard(key)
+                if debounce:
+                    self._last_run.pop(key, None)
+                    self._last_run[key] = time.monotonic()
+
+        return guarded
+
+    def format_stats(self):
+        executed = self.counters['executed']
+        saved = self.counters['in_flight'] + self.counters['debounced']
+        total = executed + saved
+        message = f"🛡️ Anti-flood pulsanti\n\n"
+        message += f"✅ Eseguiti: {executed}\n"
+        message += f"⏳ Scartati (già in corso): {self.counters['in_flight']}\n"
+        message += f"🔁 Scartati (tap ripetuti): {self.counters['debounced']}\n"
+        if total:
+            message += f"📉 Lavoro risparmiato: {saved / total * 100:.1f}%"
+        return message
+
+# Guard condivisa da tutti gli handler dei pulsanti
+callback_guard = CallbackGuard()
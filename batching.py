@@ -0,0 +1,42 @@
+import asyncio
+import time
+
+class OutcomeBuffer:
+    """Accumula chiavi raggruppate per esito e le scrive a blocchi
+
+    `write(outcome, keys)` viene awaited con al massimo `batch_size` chiavi
+    dello stesso esito e deve restituire True se la scrittura è riuscita.
+    Il flush avviene a blocco pieno o ogni `flush_interval` secondi, quindi
+    un crash perde al massimo un blocco.
+    """
+
+    def __init__(self, write, batch_size, flush_interval):
+        self.write = write
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def add(self, key, outcome):
+        keys = self._pending.setdefault(outcome, [])
+        keys.append(key)
+        if (len(keys) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            await self.flush()
+
+    async def flush(self):
+        """Scrive tutto ciò che è in attesa; False se qualche blocco è fallito"""
+        async with self._lock:
+            self._last_flush = time.monotonic()
+            ok = True
+            # Copia: add() può creare un nuovo esito mentre si attende la scrittura
+            for outcome, keys in list(self._pending.items()):
+                while keys:
+                    batch = keys[:self.batch_size]
+                    if not await self.write(outcome, batch):
+                        # Riprova al prossimo flush
+                        ok = False
+                        break
+                    del keys[:len(batch)]
+            return ok
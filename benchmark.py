@@ -0,0 +1,380 @@
+"""Benchmark del bot con Telegram e Supabase finti, in-process e offline
+
+Simula il picco di un lancio: N nuovi utenti arrivano dal link di un
+referrer (/start REF_...), cliccano PARTECIPA (verify_subscription) e poi
+aprono le statistiche (show_stats). Per ogni fase riporta latenza p50/p99
+e update al secondo.
+
+    python benchmark.py --users 2000 --api-latency 0.03 --db-latency 0.02
+
+I limiti Bot API del governor sono applicati come in produzione; con
+--no-telegram-limits si misura solo il nostro codice. Ogni /start invia
+tre messaggi, quindi con i limiti attivi regge ~10 arrivi/s. In CI:
+
+    python benchmark.py --users 300 --rate 8 --max-p99 2
+
+Con --max-p99 l'uscita è non zero se una fase supera la soglia.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+import httpx
+from supabase import acreate_client, AsyncClientOptions
+from telegram import Update
+from telegram.request import BaseRequest
+import database
+from bot import build_application, CONCURRENT_UPDATES
+from templates import INVALID_REFERRAL_TEXT
+from config import SUPABASE_URL, SUPABASE_KEY
+from leaderboard import load_leaderboard
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Contest Bot', 'username': 'contest_bench_bot'}
+CHANNEL_ID = -1001234567890
+FIRST_USER_ID = 10_000_000
+REFERRERS = 50
+# telegram_id senza utente: codici REF_ ben formati ma inesistenti
+INVALID_REFERRER = 900_000_000
+
+class FakeBotRequest(BaseRequest):
+    """Bot API finta: risponde a ogni metodo dopo `latency` secondi"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = Counter()
+        self.sent_texts = defaultdict(list)   # chat_id -> testi di sendMessage
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        body = {'ok': True, 'result': self._result(api_method, params)}
+        return 200, json.dumps(body).encode()
+
+    def _result(self, api_method, params):
+        if api_method == 'getMe':
+            return BOT_USER
+        if api_method == 'getChatMember':
+            user = {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'U'}
+            return {'status': 'member', 'user': user}
+        if api_method in ('sendMessage', 'editMessageText'):
+            self._message_id += 1
+            chat_id = int(params.get('chat_id', 0))
+            if api_method == 'sendMessage':
+                self.sent_texts[chat_id].append(params.get('text', ''))
+            return {'message_id': self._message_id, 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        return True
+
+class FakeSupabase:
+    """PostgREST in memoria (tabelle come liste di dict) usato come transport httpx"""
+
+    DEFAULTS = {
+        'users': {'total_invites': 0, 'final_position': None},
+        'referrals': {'final_verification_status': None},
+    }
+    # Colonne con indice (come in produzione): le lookup non scansionano la tabella
+    INDEXED = {
+        'users': ('telegram_id', 'referral_code'),
+        'referrals': ('referred_telegram_id',),
+    }
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = Counter()
+        self.tables = {'users': [], 'referrals': [], 'contest_settings': []}
+        self._indexes = {}
+        self.rpcs = {
+            'complete_referral': self._complete_referral,
+            'load_interaction_context': self._load_interaction_context,
+            'register_via_referral': self._register_via_referral,
+        }
+
+    async def __call__(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        path = request.url.path
+        name = path.rsplit('/', 1)[-1]
+        self.requests[f"{request.method} {name}"] += 1
+
+        if '/rpc/' in path:
+            params = json.loads(request.content or b'{}')
+            return httpx.Response(200, json=self.rpcs[name](**params))
+
+        rows = self.tables.setdefault(name, [])
+        if request.method == 'POST':
+            body = json.loads(request.content)
+            new_rows = body if isinstance(body, list) else [body]
+            for row in new_rows:
+                row.setdefault('id', len(rows) + 1)
+                # Valori di default delle colonne come nello schema reale
+                for column, value in self.DEFAULTS.get(name, {}).items():
+                    row.setdefault(column, value)
+                self._insert(name, row)
+            return httpx.Response(201, json=new_rows)
+
+        filters = self._parse_filters(request.url.params)
+        matched = [row for row in self._candidates(name, filters) if self._matches(row, filters)]
+        if request.method == 'PATCH':
+            changes = json.loads(request.content)
+            for row in matched:
+                row.update(changes)
+        elif request.method == 'DELETE':
+            remaining = [row for row in rows if row not in matched]
+            self.tables[name] = []
+            self._indexes = {key: index for key, index in self._indexes.items() if key[0] != name}
+            for row in remaining:
+                self._insert(name, row)
+        return httpx.Response(200, json=matched)
+
+    def _insert(self, table, row):
+        self.tables.setdefault(table, []).append(row)
+        for column in self.INDEXED.get(table, ()):
+            index = self._indexes.setdefault((table, column), {})
+            index.setdefault(self._format(row.get(column)), []).append(row)
+
+    def _candidates(self, table, filters):
+        """Righe da controllare: via indice se c'è un filtro eq su una colonna indicizzata"""
+        for column, operator, expected in filters:
+            index = self._indexes.get((table, column))
+            if operator == 'eq' and index is not None:
+                return index.get(expected, [])
+        return self.tables.get(table, [])
+
+    @staticmethod
+    def _format(value):
+        if value is None:
+            return 'null'
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        return str(value)
+
+    @staticmethod
+    def _parse_filters(params):
+        filters = []
+        for column, condition in params.multi_items():
+            if column in ('select', 'order', 'limit', 'offset', 'on_conflict'):
+                continue
+            operator, _, expected = condition.partition('.')
+            filters.append((column, operator, expected))
+        return filters
+
+    def _matches(self, row, filters):
+        for column, operator, expected in filters:
+            actual = self._format(row.get(column))
+            if operator == 'eq' and actual != expected:
+                return False
+            if operator == 'neq' and actual == expected:
+                return False
+            if operator == 'is' and actual != expected:
+                return False
+            if operator == 'in' and actual not in expected.strip('()').split(','):
+                return False
+            if operator == 'gt' and not float(actual) > float(expected):
+                return False
+        return True
+
+    def _find(self, table, **filters):
+        candidates = self._candidates(table, [(key, 'eq', self._format(value)) for key, value in filters.items()])
+        return [row for row in candidates
+                if all(row.get(key) == value for key, value in filters.items())]
+
+    def _complete_referral(self, p_referrer_id, p_referred_id):
+        pending = self._find('referrals', referrer_telegram_id=p_referrer_id,
+                             referred_telegram_id=p_referred_id, status='pending')
+        if not pending:
+            completed = self._find('referrals', referrer_telegram_id=p_referrer_id,
+                                   referred_telegram_id=p_referred_id, status='completed')
+            return 'already_completed' if completed else 'not_found'
+        for row in pending:
+            row.update(status='completed', membership_status='member')
+        for user in self._find('users', telegram_id=p_referred_id):
+            user['referred_by'] = p_referrer_id
+        for user in self._find('users', telegram_id=p_referrer_id):
+            user['total_invites'] += len(pending)
+        return 'completed'
+
+    def _register_via_referral(self, p_telegram_id, p_username, p_first_name, p_referral_code):
+        if self._find('users', telegram_id=p_telegram_id):
+            return {'status': 'already_registered'}
+        referrers = self._find('users', referral_code=p_referral_code)
+        if not referrers:
+            return {'status': 'invalid_code'}
+        referrer = referrers[0]
+        self._insert('users', dict(self.DEFAULTS['users'], telegram_id=p_telegram_id, username=p_username,
+                                   first_name=p_first_name, referral_code=f"REF_{p_telegram_id}",
+                                   referred_by=None))
+        self._insert('referrals', dict(self.DEFAULTS['referrals'], referrer_telegram_id=referrer['telegram_id'],
+                                       referred_telegram_id=p_telegram_id, status='pending'))
+        return {'status': 'registered',
+                'referrer': {'telegram_id': referrer['telegram_id'], 'first_name': referrer['first_name']}}
+
+    def _load_interaction_context(self, p_telegram_id):
+        users = self._find('users', telegram_id=p_telegram_id)
+        pending = self._find('referrals', referred_telegram_id=p_telegram_id, status='pending')
+        return {'user': users[0] if users else None,
+                'pending_referral': pending[0] if pending else None}
+
+    def seed(self, referrers):
+        self._insert('contest_settings', {
+            'id': 1, 'is_active': True, 'status': 'active', 'results_announced': False,
+            'contest_name': 'Benchmark', 'prize_description': 'Viaggio per due persone',
+            'channel_id': CHANNEL_ID, 'channel_invite_link': 'https://t.me/+benchmark',
+            'start_date': '2026-01-01T00:00:00', 'end_date': '2099-01-01T00:00:00'
+        })
+        for i in range(referrers):
+            telegram_id = i + 1000
+            self._insert('users', {
+                'id': i + 1, 'telegram_id': telegram_id, 'username': None, 'first_name': f"Ref{i}",
+                'referral_code': f"REF_{telegram_id}", 'referred_by': None, 'total_invites': 0
+            })
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+
+def start_update(update_id, user_id, referral_code):
+    text = f"/start {referral_code}"
+    return {'update_id': update_id, 'message': {
+        'message_id': 1, 'date': int(time.time()), 'text': text,
+        'chat': {'id': user_id, 'type': 'private'}, 'from': _user(user_id),
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+    }}
+
+def callback_update(update_id, user_id, data):
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': _user(user_id), 'chat_instance': str(user_id), 'data': data,
+        'message': {'message_id': 2, 'date': int(time.time()), 'text': '...',
+                    'chat': {'id': user_id, 'type': 'private'}, 'from': BOT_USER}
+    }}
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+async def run_phase(app, name, payloads, concurrency, rate):
+    """Processa gli update (al massimo `concurrency` insieme) e misura le latenze"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def process(payload):
+        update = Update.de_json(payload, app.bot)
+        submitted = time.perf_counter()
+        async with semaphore:
+            await app.process_update(update)
+        latencies.append(time.perf_counter() - submitted)
+
+    start = time.perf_counter()
+    tasks = []
+    for i, payload in enumerate(payloads):
+        if rate:
+            # Arrivi a ritmo costante invece che tutti insieme
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(process(payload)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'phase': name, 'updates': len(latencies), 'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 0.50), 'p99': percentile(latencies, 0.99),
+        'max': max(latencies)
+    }
+
+async def run_benchmark(args):
+    fake_db = FakeSupabase(args.db_latency)
+    fake_db.seed(REFERRERS)
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(fake_db))
+    database.set_client(await acreate_client(
+        SUPABASE_URL, SUPABASE_KEY, options=AsyncClientOptions(httpx_client=http_client)
+    ))
+    # Classifica e indice dei codici caricati come all'avvio del bot
+    await load_leaderboard()
+
+    fake_api = FakeBotRequest(args.api_latency)
+    # Con --no-telegram-limits si misura solo il nostro codice, non i limiti della Bot API
+    app = build_application(webhook=True, request=fake_api, rate_limited=args.telegram_limits)
+    errors = []
+
+    async def count_error(update, context):
+        errors.append(context.error)
+    app.add_error_handler(count_error)
+
+    users = [FIRST_USER_ID + i for i in range(args.users)]
+    spam_users = [FIRST_USER_ID + args.users + i for i in range(args.users)]
+    phases = [
+        ('start_referral', [start_update(i, user_id, f"REF_{1000 + i % REFERRERS}")
+                            for i, user_id in enumerate(users)]),
+        ('verify_subscription', [callback_update(i, user_id, 'verify_subscription')
+                                 for i, user_id in enumerate(users)]),
+        ('show_stats', [callback_update(i, user_id, 'show_stats')
+                        for i, user_id in enumerate(users)]),
+        # Link falsi o sbagliati: i codici malformati e quelli già nella cache negativa
+        # non arrivano alla RPC di registrazione
+        ('start_invalid_code', [start_update(i, user_id, f"REF_{INVALID_REFERRER + i % 10}" if i % 2 else "REF_abc")
+                                for i, user_id in enumerate(spam_users)]),
+    ]
+
+    results = []
+    async with app:
+        # I print degli handler vanno scartati: falserebbero i tempi sul terminale
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for name, payloads in phases:
+                results.append(await run_phase(app, name, payloads, args.concurrency, args.rate))
+    await http_client.aclose()
+
+    completed = len(fake_db._find('referrals', status='completed'))
+    # Ogni link non valido deve ricevere il messaggio dedicato, non un errore generico
+    wrong_replies = sum(fake_api.sent_texts[user_id] != [INVALID_REFERRAL_TEXT] for user_id in spam_users)
+    return results, completed, wrong_replies, errors, fake_api.calls, fake_db.requests
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline degli handler del bot")
+    parser.add_argument('--users', type=int, default=1000, help="nuovi utenti simulati")
+    parser.add_argument('--api-latency', type=float, default=0.03, help="latenza Bot API finta (s)")
+    parser.add_argument('--db-latency', type=float, default=0.02, help="latenza Supabase finta (s)")
+    parser.add_argument('--concurrency', type=int, default=CONCURRENT_UPDATES, help="update in parallelo")
+    parser.add_argument('--rate', type=float, default=0, help="arrivi al secondo (0 = tutti insieme)")
+    parser.add_argument('--no-telegram-limits', dest='telegram_limits', action='store_false',
+                        help="disattiva i limiti Bot API del governor (30 invii/s, 1 msg/s per chat)")
+    parser.add_argument('--max-p99', type=float, default=None, help="soglia p99 (s) per fallire in CI")
+    args = parser.parse_args()
+
+    results, completed, wrong_replies, errors, api_calls, db_requests = asyncio.run(run_benchmark(args))
+
+    print(f"\n{'fase':<22}{'update':>8}{'upd/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for r in results:
+        print(f"{r['phase']:<22}{r['updates']:>8}{r['throughput']:>10.1f}"
+              f"{r['p50'] * 1000:>10.1f}{r['p99'] * 1000:>10.1f}{r['max'] * 1000:>10.1f}")
+    print(f"\nReferral completati: {completed}/{args.users}")
+    print(f"Chiamate Bot API: {dict(api_calls)}")
+    print(f"Richieste Supabase: {dict(db_requests)}")
+    if errors:
+        print(f"❌ Errori negli handler: {len(errors)} (primo: {errors[0]!r})")
+    if wrong_replies:
+        print(f"❌ Link non validi senza risposta \"{INVALID_REFERRAL_TEXT}\": {wrong_replies}/{args.users}")
+
+    failed = bool(errors) or completed != args.users or bool(wrong_replies)
+    if args.max_p99 is not None:
+        slow = [r['phase'] for r in results if r['p99'] > args.max_p99]
+        if slow:
+            print(f"❌ p99 oltre {args.max_p99 * 1000:.0f} ms: {', '.join(slow)}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
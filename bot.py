@@ -1,66 +1,54 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
-from config import TELEGRAM_BOT_TOKEN, ADMIN_IDS
-from database import (get_current_contest, user_exists, create_user, get_user, 
-                     create_pending_referral, get_user_by_referral_code, complete_referral,
+from telegram import Update
+from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, ChatMemberHandler, ExtBot
+from config import (TELEGRAM_BOT_TOKEN, ADMIN_IDS, BOT_MODE, PORT, WEBHOOK_URL, WEBHOOK_SECRET,
+                    TELEGRAM_API_BASE_URL, SHARD_URLS, SHARD_INDEX)
+from database import (get_current_contest, create_user, get_user, 
+                     register_via_referral, complete_referral,
                      get_pending_referral, get_contest_status, start_final_verification,
-                     announce_results, check_contest_end, get_contest_with_status,
-                     check_contest_should_start, activate_scheduled_contest)
-from verification import run_final_verification
-from broadcast import broadcast_contest_results
+                     announce_results, get_contest_with_status, close_client,
+                     get_latest_broadcast_job, get_broadcast_progress, load_interaction_context,
+                     contest_state, set_referral_membership)
+from verification import run_final_verification, resume_final_verification
+from lifecycle import contest_lifecycle_loop
+from reverification import reverification_loop
+from broadcast import broadcast_contest_results, resume_broadcast_jobs, format_job_progress
+from webserver import make_web_app, WEBHOOK_PATH
+from leaderboard import leaderboard, leaderboard_resync_loop
+from referral_codes import referral_codes
+from membership import membership, MEMBER_STATUSES
+from antiflood import callback_guard
+from metrics import InstrumentedRequest, timed_handler
+from governor import governor, INTERACTIVE, BULK
+from state_store import create_state_store
+from templates import (get_templates, referral_link, MAIN_MENU_KEYBOARD, STATS_ONLY_KEYBOARD, BACK_KEYBOARD,
+                       BACK_TO_MENU_KEYBOARD, VERIFY_REFERRAL_KEYBOARD, VERIFY_DIRECT_KEYBOARD,
+                       JOIN_STEP_TEXT, VERIFY_STEP_TEXT, SHARE_INSTRUCTIONS_TEXT, INVALID_REFERRAL_TEXT)
+from telegram.helpers import escape_markdown
 import asyncio
-from datetime import datetime
+import signal
 
-# Dizionario globale per tenere traccia dei messaggi da cancellare
-pending_share_messages = {}
+# Update richiesti a Telegram: chat_member serve al ledger delle iscrizioni al canale
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER]
 
-def get_full_prize_text(contest):
-    """Restituisce il testo completo dei premi (1°-5° posto)"""
-    prize_text = f"🏆 Premio: {contest['prize_description']}\n"
-    prize_text += f"🥈 2° posto → Bonus 50€\n"
-    prize_text += f"🥉 3° posto → Bonus 25€\n"
-    prize_text += f"4️⃣ 4° posto → Bonus 15€\n"
-    prize_text += f"5️⃣ 5° posto → Bonus 10€"
-    return prize_text
+# Numero massimo di update gestiti in parallelo dall'Application
+CONCURRENT_UPDATES = 256
+# Connessioni HTTP verso la Bot API (default di python-telegram-bot)
+BOT_API_POOL_SIZE = 256
+# Pool separato per broadcast, verifiche e ricontrolli: non occupano le connessioni degli utenti
+BULK_POOL_SIZE = 32
+# Chiave di bot_data con il Bot dei job massivi (corsia bulk del governor)
+BULK_BOT_KEY = 'bulk_bot'
 
-async def periodic_contest_check(bot, admin_id):
-    """Controllo periodico integrato nel bot"""
-    while True:
-        try:
-            print(f"🕐 Controllo contest: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            
-            # Controllo se contest schedulato deve iniziare
-            if check_contest_should_start():
-                print("🚀 Attivando contest automaticamente...")
-                if activate_scheduled_contest():
-                    await bot.send_message(admin_id, "🚀 Contest avviato automaticamente!")
-                    print("✅ Contest attivato")
-                else:
-                    print("❌ Errore attivazione contest")
-            
-            # Controllo se contest attivo deve terminare
-            if check_contest_end():
-                print("🕐 Contest scaduto - avvio verifica automatica")
-                if start_final_verification():
-                    print("🔍 Avvio verifica finale automatica...")
-                    await run_final_verification(bot, admin_id)
-                else:
-                    print("❌ Errore avvio verifica finale")
-            
-            # Attendi 1 ora prima del prossimo controllo (3600 secondi)
-            # Per test puoi usare 60 secondi
-            await asyncio.sleep(3600)
-            
-        except Exception as e:
-            print(f"❌ Errore controllo periodico: {e}")
-            await asyncio.sleep(300)  # Se errore, riprova dopo 5 minuti
+# Messaggi di condivisione da cancellare, per utente (Telegram li cancella solo entro 48 ore)
+SHARE_MESSAGE_TTL = 48 * 3600
+pending_share_messages = create_state_store('share_message', SHARE_MESSAGE_TTL)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
    user_id = update.effective_user.id
    username = update.effective_user.username
    first_name = update.effective_user.first_name
    
-   contest = get_current_contest()
+   contest = await get_current_contest()
    if not contest:
        await update.message.reply_text("❌ Nessun contest configurato al momento.")
        return
@@ -71,20 +59,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
    
    # Gestisci contest non ancora iniziato
    if contest_status == 'scheduled':
-       start_date_str = contest['start_date'].split('T')[0]  
-       start_time = contest['start_date'].split('T')[1][:5]  
-    
-       # Aggiungi 2 ore
-       hour, minute = start_time.split(':')
-       hour = int(hour) + 2
-       start_time = f"{hour:02d}:{minute}"
-    
-       message = f"⏰ Contest non ancora iniziato\n\n"
-       message += f"📅 Inizio: {start_date_str} alle {start_time}\n\n"
-       message += get_full_prize_text(contest) + "\n\n"
-       message += f"Torna quando il contest sarà attivo!"
-    
-       await update.message.reply_text(message)
+       await update.message.reply_text(get_templates(contest).scheduled_text)
        return
    # Controllo altri stati
    if contest_status == 'verification_in_progress':
@@ -100,16 +75,32 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
        referral_code = context.args[0]
        print(f"🔗 Utente {user_id} arriva tramite: {referral_code}")
    
-   if user_exists(user_id):
+   # Deep link: registrazione in un solo round-trip; se l'utente esiste già prosegue sotto.
+   # I codici malformati o già risultati inesistenti non arrivano alla RPC
+   invalid_code = bool(referral_code) and not await referral_codes.may_exist(referral_code)
+   # Con la classifica caricata gli utenti registrati sono tutti in memoria (ogni replica
+   # gestisce i propri): un codice rifiutato per un utente nuovo non arriva a Supabase
+   if invalid_code and referral_codes.loaded and user_id not in leaderboard:
+       await update.message.reply_text(INVALID_REFERRAL_TEXT)
+       return
+   if referral_code and not invalid_code and contest_status != 'completed':
+       if await handle_referral_user(update, context, referral_code, contest):
+           return
+   
+   user_data, pending_referral, _ = await load_interaction_context(user_id)
+   if user_data:
        # Utente esistente
-       await handle_existing_user(update, context, contest)
+       await handle_existing_user(update, context, contest, user_data, pending_referral)
    else:
        if referral_code:
            # Contest terminato - non accettare nuovi referral
            if contest_status == 'completed':
                await update.message.reply_text("❌ Contest terminato. Non è più possibile iscriversi tramite referral.")
                return
-           await handle_referral_user(update, context, referral_code, contest)
+           if invalid_code:
+               await update.message.reply_text(INVALID_REFERRAL_TEXT)
+               return
+           await update.message.reply_text("❌ Errore durante la registrazione.")
        else:
            # Contest terminato - non accettare nuovi utenti diretti
            if contest_status == 'completed':
@@ -117,16 +108,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                return
            await handle_direct_user(update, context, contest)
 
-async def handle_existing_user(update, context, contest):
-    user_id = update.effective_user.id
-    contest_status, results_announced = get_contest_status()
+async def handle_existing_user(update, context, contest, user_data, pending_referral):
+    contest_status, results_announced = contest_state(contest)
     
     # Se contest completato e risultati annunciati, mostra direttamente le stats finali
     if contest_status == 'completed' and results_announced:
-        user_data = get_user(user_id)
-        
-        keyboard = [[InlineKeyboardButton("🔙 Menu principale", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = BACK_TO_MENU_KEYBOARD
         
         # Messaggio speciale per il vincitore (primo posto) - INVARIATO
         if user_data.get('final_position') == 1:
@@ -158,14 +145,10 @@ async def handle_existing_user(update, context, contest):
         return
     
     # Controlla se ha referral pending (processo incompleto)
-    pending_referral = get_pending_referral(user_id)
     if pending_referral:
         # Utente ha processo incompleto - mostra di nuovo i bottoni
-        referrer = get_user(pending_referral['referrer_telegram_id'])
-        
-        keyboard = [[InlineKeyboardButton("🔗 ISCRIVITI AL CANALE", url=contest['channel_invite_link'])]]
-        keyboard.append([InlineKeyboardButton("✅ PARTECIPA", callback_data="verify_subscription")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        referrer = await get_user(pending_referral['referrer_telegram_id'])
+        reply_markup = get_templates(contest).join_verify_keyboard
         
         message = f"🎯 Hai un invito in sospeso da {referrer['first_name']}!\n\n"
         message += f"Completa l'iscrizione al canale per partecipare al contest.\n\n"
@@ -175,68 +158,41 @@ async def handle_existing_user(update, context, contest):
         return
     
     # Utente normale già registrato - contest attivo
-    user_data = get_user(user_id)
-    referral_link = f"https://t.me/{context.bot.username}?start={user_data['referral_code']}"
-    
-    # NUOVO: Keyboard con pulsanti condivisione e stats
-    keyboard = [
-        [InlineKeyboardButton("📊 Le mie statistiche", callback_data="show_stats")],
-        [InlineKeyboardButton("🚀 Condividi il mio link", callback_data="share_link")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    message = f"🎉 Bentornato al Contest {contest['contest_name']}! 🎉\n\n"
-    message += f"📜 Il regolamento è semplicissimo: vince chi porta più iscritti al canale Telegram di Vivio!\n\n"
-    message += get_full_prize_text(contest) + "\n"
-    message += f"💥 Persone invitate: {user_data['total_invites']}\n\n"
-    message += f"👉 Condividi il tuo link d'invito tramite il tasto qui sotto con tutti i tuoi amici… e che vinca il migliore! 🚀"
-    
-    await update.message.reply_text(message, reply_markup=reply_markup)
+    message = get_templates(contest).welcome_back_text(user_data['total_invites'])
+    
+    await update.message.reply_text(message, reply_markup=MAIN_MENU_KEYBOARD)
 
 async def handle_direct_user(update, context, contest):
     user_id = update.effective_user.id
     username = update.effective_user.username
     first_name = update.effective_user.first_name
     
-    # MESSAGGIO 1: Benvenuto
-    message1 = f"🎉 Benvenuto al contest {contest['contest_name']}!\n\n"
-    message1 += f"Per partecipare al contest segui questi due passaggi ⬇️"
+    templates = get_templates(contest)
     
-    await update.message.reply_text(message1)
+    # MESSAGGIO 1: Benvenuto
+    await update.message.reply_text(templates.direct_welcome_text)
     
     # MESSAGGIO 2: Iscrizione canale
-    message2 = f"1️⃣ SEGUI IL CANALE TELEGRAM DI VIVIO\n\n"
-    message2 += f"(una volta seguito clicca sulla freccia ⬅️ in alto a sinistra per tornare qui)"
-    
-    keyboard2 = [[InlineKeyboardButton("🔗 ISCRIVITI AL CANALE", url=contest['channel_invite_link'])]]
-    reply_markup2 = InlineKeyboardMarkup(keyboard2)
-    
-    await update.message.reply_text(message2, reply_markup=reply_markup2)
+    await update.message.reply_text(JOIN_STEP_TEXT, reply_markup=templates.join_keyboard)
     
     # MESSAGGIO 3: Verifica
-    message3 = f"2️⃣ CLICCA QUI PER ACCEDERE AL CONTEST⬇️"
-    
-    keyboard3 = [[InlineKeyboardButton("✅ PARTECIPA", callback_data="verify_direct_subscription")]]
-    reply_markup3 = InlineKeyboardMarkup(keyboard3)
-    
-    await update.message.reply_text(message3, reply_markup=reply_markup3)
+    await update.message.reply_text(VERIFY_STEP_TEXT, reply_markup=VERIFY_DIRECT_KEYBOARD)
 
 async def handle_referral_user(update, context, referral_code, contest):
+    """Registra il nuovo utente col referral pending; False se era già registrato"""
     user_id = update.effective_user.id
     username = update.effective_user.username
     first_name = update.effective_user.first_name
     
-    referrer = get_user_by_referral_code(referral_code)
-    if not referrer:
-        await update.message.reply_text("❌ Link di invito non valido.")
-        return
-    
-    new_user = create_user(user_id, username, first_name)
-    if not new_user:
+    outcome, referrer = await register_via_referral(user_id, username, first_name, referral_code)
+    if outcome == 'already_registered':
+        return False
+    if outcome == 'invalid_code':
+        await update.message.reply_text(INVALID_REFERRAL_TEXT)
+        return True
+    if outcome != 'registered':
         await update.message.reply_text("❌ Errore durante la registrazione.")
-        return
-    
-    create_pending_referral(referrer['telegram_id'], user_id)
+        return True
     
     # MESSAGGIO 1: Invito da referrer
     message1 = f"🎯 Sei stato invitato da {referrer['first_name']}!\n\n"
@@ -245,60 +201,33 @@ async def handle_referral_user(update, context, referral_code, contest):
     await update.message.reply_text(message1)
     
     # MESSAGGIO 2: Iscrizione canale
-    message2 = f"1️⃣ SEGUI IL CANALE TELEGRAM DI VIVIO\n\n"
-    message2 += f"(una volta seguito clicca sulla freccia ⬅️ in alto a sinistra per tornare qui)"
-    
-    keyboard2 = [[InlineKeyboardButton("🔗 ISCRIVITI AL CANALE", url=contest['channel_invite_link'])]]
-    reply_markup2 = InlineKeyboardMarkup(keyboard2)
-    
-    await update.message.reply_text(message2, reply_markup=reply_markup2)
+    await update.message.reply_text(JOIN_STEP_TEXT, reply_markup=get_templates(contest).join_keyboard)
     
     # MESSAGGIO 3: Verifica
-    message3 = f"2️⃣ CLICCA QUI PER ACCEDERE AL CONTEST⬇️"
-    
-    keyboard3 = [[InlineKeyboardButton("✅ PARTECIPA", callback_data="verify_subscription")]]
-    reply_markup3 = InlineKeyboardMarkup(keyboard3)
-    
-    await update.message.reply_text(message3, reply_markup=reply_markup3)
+    await update.message.reply_text(VERIFY_STEP_TEXT, reply_markup=VERIFY_REFERRAL_KEYBOARD)
+    return True
 
 async def verify_subscription_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     user_id = query.from_user.id
-    contest = get_current_contest()
+    contest = await get_current_contest()
     
     # Controllo stato contest
-    contest_status, _ = get_contest_status()
+    contest_status, _ = await get_contest_status()
     if contest_status != 'active':
         await query.edit_message_text("🔄 Contest terminato. Non è più possibile completare iscrizioni.")
         return
     
     try:
-        member = await context.bot.get_chat_member(contest['channel_id'], user_id)
-        if member.status in ['member', 'administrator', 'creator']:
+        if await membership.is_member(context.bot, contest['channel_id'], user_id):
             # Utente iscritto - completa referral
-            pending_referral = get_pending_referral(user_id)
+            pending_referral = await get_pending_referral(user_id)
             if pending_referral:
-                success = complete_referral(pending_referral['referrer_telegram_id'], user_id)
+                success = await complete_referral(pending_referral['referrer_telegram_id'], user_id)
                 if success:
-                    user_data = get_user(user_id)
-                    referral_link = f"https://t.me/{context.bot.username}?start={user_data['referral_code']}"
-                    
-                    # NUOVO: Keyboard con pulsanti condivisione e stats
-                    keyboard = [
-                        [InlineKeyboardButton("📊 Le mie statistiche", callback_data="show_stats")],
-                        [InlineKeyboardButton("🚀 Condividi il mio link", callback_data="share_link")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    message = f"🎉 Benvenuto al Contest! 🎉\n\n"
-                    message += f"✅ Sei ora registrato al contest {contest['contest_name']}\n\n"
-                    message += f"📜 Il regolamento è semplicissimo: vince chi porta più iscritti al canale Telegram di Vivio!\n\n"
-                    message += get_full_prize_text(contest) + "\n\n"
-                    message += f"👉 Condividi il tuo link d'invito tramite il tasto qui sotto con tutti i tuoi amici… e che vinca il migliore! 🚀"
-                    
-                    await query.edit_message_text(message, reply_markup=reply_markup)
+                    await query.edit_message_text(get_templates(contest).welcome_text, reply_markup=MAIN_MENU_KEYBOARD)
                 else:
                     await query.edit_message_text("❌ Errore nel completamento. Contatta il supporto.")
             else:
@@ -308,9 +237,7 @@ async def verify_subscription_callback(update: Update, context: ContextTypes.DEF
             import time
             timestamp = int(time.time()) % 100  # Ultimi 2 cifre del timestamp
             
-            keyboard = [[InlineKeyboardButton("🔗 ISCRIVITI AL CANALE", url=contest['channel_invite_link'])]]
-            keyboard.append([InlineKeyboardButton("✅ PARTECIPA", callback_data="verify_subscription")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = get_templates(contest).join_verify_keyboard
             
             await query.edit_message_text(
                 f"❌ Non risulti iscritto al canale.\n\nIscriviti prima di continuare. [{timestamp}]",
@@ -318,9 +245,7 @@ async def verify_subscription_callback(update: Update, context: ContextTypes.DEF
             )
     except Exception as e:
         print(f"❌ Errore verifica: {e}")
-        keyboard = [[InlineKeyboardButton("🔗 ISCRIVITI AL CANALE", url=contest['channel_invite_link'])]]
-        keyboard.append([InlineKeyboardButton("✅ PARTECIPA", callback_data="verify_subscription")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = get_templates(contest).join_verify_keyboard
         
         await query.message.reply_text(
             "❌ Errore durante la verifica. Iscriviti al canale e riprova:",
@@ -334,30 +259,14 @@ async def verify_direct_subscription_callback(update: Update, context: ContextTy
     user_id = query.from_user.id
     username = query.from_user.username
     first_name = query.from_user.first_name
-    contest = get_current_contest()
+    contest = await get_current_contest()
     
     try:
-        member = await context.bot.get_chat_member(contest['channel_id'], user_id)
-        if member.status in ['member', 'administrator', 'creator']:
+        if await membership.is_member(context.bot, contest['channel_id'], user_id):
             # Utente iscritto - registra come utente diretto
-            new_user = create_user(user_id, username, first_name)
+            new_user = await create_user(user_id, username, first_name)
             if new_user:
-                referral_link = f"https://t.me/{context.bot.username}?start={new_user['referral_code']}"
-                
-                # NUOVO: Keyboard con pulsanti condivisione e stats
-                keyboard = [
-                    [InlineKeyboardButton("📊 Le mie statistiche", callback_data="show_stats")],
-                    [InlineKeyboardButton("🚀 Condividi il mio link", callback_data="share_link")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                message = f"🎉 Benvenuto al Contest! 🎉\n\n"
-                message += f"✅ Sei ora registrato al contest {contest['contest_name']}\n\n"
-                message += f"📜 Il regolamento è semplicissimo: vince chi porta più iscritti al canale Telegram di Vivio!\n\n"
-                message += get_full_prize_text(contest) + "\n\n"
-                message += f"👉 Condividi il tuo link d'invito tramite il tasto qui sotto con tutti i tuoi amici… e che vinca il migliore! 🚀"
-                
-                await query.edit_message_text(message, reply_markup=reply_markup)
+                await query.edit_message_text(get_templates(contest).welcome_text, reply_markup=MAIN_MENU_KEYBOARD)
             else:
                 await query.edit_message_text("❌ Errore durante la registrazione.")
         else:
@@ -365,9 +274,7 @@ async def verify_direct_subscription_callback(update: Update, context: ContextTy
             import time
             timestamp = int(time.time()) % 100
             
-            keyboard = [[InlineKeyboardButton("🔗 ISCRIVITI AL CANALE", url=contest['channel_invite_link'])]]
-            keyboard.append([InlineKeyboardButton("✅ PARTECIPA", callback_data="verify_direct_subscription")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = get_templates(contest).join_verify_direct_keyboard
             
             await query.edit_message_text(
                 f"❌ Non risulti iscritto al canale.\n\nIscriviti prima di continuare. [{timestamp}]",
@@ -382,43 +289,34 @@ async def show_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     
     user_id = query.from_user.id
+    user_data, _, contest = await load_interaction_context(user_id)
     
-    if not user_exists(user_id):
+    if not user_data:
         await query.edit_message_text("❌ Non sei registrato. Usa /start per registrarti.")
         return
     
     # Controllo stato contest e accesso stats
-    contest_status, results_announced = get_contest_status()
+    contest_status, results_announced = contest_state(contest)
     
     if contest_status == 'verification_in_progress':
         # Durante verifica - nessun dato accessibile
-        keyboard = [[InlineKeyboardButton("🔙 Torna indietro", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
             "🔄 Verifica finale in corso...\n\nI risultati saranno disponibili a breve.",
-            reply_markup=reply_markup
+            reply_markup=BACK_KEYBOARD
         )
         return
     
     if contest_status == 'completed' and not results_announced:
         # Contest finito ma risultati non ancora annunciati
-        keyboard = [[InlineKeyboardButton("🔙 Torna indietro", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
             "🏁 Contest terminato.\n\nAttendi l'annuncio ufficiale dei risultati.",
-            reply_markup=reply_markup
+            reply_markup=BACK_KEYBOARD
         )
         return
     
     # Stats normali o finali (se annunciati)
-    user_data = get_user(user_id)
-    contest = get_current_contest()
-
-    if user_data and contest:
-        keyboard = [[InlineKeyboardButton("🔙 Torna indietro", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    if contest:
+        reply_markup = BACK_KEYBOARD
         
         if contest_status == 'completed' and results_announced:
             # Messaggio per il vincitore - INVARIATO
@@ -448,11 +346,25 @@ async def show_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
                 message += f"Il contest {contest['contest_name']} è terminato.\nGrazie per la partecipazione!"
         else:
             # Stats durante contest attivo con link per copia manuale
-            referral_link = f"https://t.me/{context.bot.username}?start={user_data['referral_code']}"
+            link = referral_link(context.bot.username, user_data['referral_code'])
             message = f"📊 **LE TUE STATISTICHE**\n\n"
-            message += f"💥 Persone invitate: {user_data['total_invites']}\n\n"
-            message += f"🔗 Il tuo link referral:\n`{referral_link}`\n\n"
-            message += get_full_prize_text(contest)
+            message += f"💥 Persone invitate: {user_data['total_invites']}\n"
+            
+            # Classifica live dalla memoria, senza query
+            position = leaderboard.position(user_id)
+            if position:
+                message += f"🏅 La tua posizione attuale: #{position} su {len(leaderboard)}\n"
+            message += "\n"
+            
+            top_users = leaderboard.top(5)
+            if top_users:
+                message += "🔝 Classifica attuale:\n"
+                for rank, name, invites in top_users:
+                    message += f"{rank}. {escape_markdown(name or '-')} - {invites} inviti\n"
+                message += "\n"
+            
+            message += f"🔗 Il tuo link referral:\n`{link}`\n\n"
+            message += get_templates(contest).prize_text
         
         await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
 
@@ -461,15 +373,15 @@ async def share_link_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     
     user_id = query.from_user.id
-    contest = get_current_contest()
+    user_data, _, contest = await load_interaction_context(user_id)
     
-    if not user_exists(user_id):
+    if not user_data:
         await query.edit_message_text("❌ Non sei registrato. Usa /start per registrarti.")
         return
     
     # Cancella eventuale messaggio precedente per questo utente
-    if user_id in pending_share_messages:
-        old_message_id = pending_share_messages[user_id]
+    old_message_id = await pending_share_messages.pop(user_id)
+    if old_message_id:
         try:
             await context.bot.delete_message(
                 chat_id=query.message.chat_id, 
@@ -479,30 +391,19 @@ async def share_link_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         except Exception as e:
             print(f"⚠️ Impossibile cancellare messaggio precedente: {e}")
     
-    user_data = get_user(user_id)
-    referral_link = f"https://t.me/{context.bot.username}?start={user_data['referral_code']}"
+    link = referral_link(context.bot.username, user_data['referral_code'])
     
     # Prima invia un messaggio di istruzioni
-    keyboard = [[InlineKeyboardButton("🔙 Torna indietro", callback_data="back_to_main")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    instruction_message = f"📢 **CONDIVIDI IL TUO LINK**\n\n"
-    instruction_message += f"Il prossimo messaggio contiene il tuo link di invito già pronto.\n\n"
-    instruction_message += f"📱 **Come fare:**\n"
-    instruction_message += f"1️⃣ Tieni premuto sul messaggio qui sotto\n"
-    instruction_message += f"2️⃣ Seleziona 'Copia'\n"
-    instruction_message += f"3️⃣ Incolla su WhatsApp, Instagram, Facebook o ovunque vuoi!"
-    
-    await query.edit_message_text(instruction_message, reply_markup=reply_markup, parse_mode='Markdown')
+    await query.edit_message_text(SHARE_INSTRUCTIONS_TEXT, reply_markup=BACK_KEYBOARD, parse_mode='Markdown')
     
     # Poi invia il messaggio da copiare come messaggio separato
-    share_text = f"🎉 Partecipa al contest {contest['contest_name']} e vinci {contest['prize_description']}!\n\nUsa il mio link per partecipare:\n{referral_link}\n\nNon perdere questa opportunità!"
+    share_text = get_templates(contest).share_text(link)
     
     # Invia il messaggio e salva l'ID per cancellarlo quando necessario
     share_message = await query.message.reply_text(share_text)
     
     # Salva solo l'ID del messaggio nel dizionario
-    pending_share_messages[user_id] = share_message.message_id
+    await pending_share_messages.set(user_id, share_message.message_id)
     
     print(f"📤 Messaggio condivisione creato per utente {user_id}: {share_message.message_id}")
 
@@ -542,54 +443,55 @@ async def back_to_main_callback(update: Update, context: ContextTypes.DEFAULT_TY
     await query.answer()
     
     user_id = query.from_user.id
-    contest = get_current_contest()
-    contest_status, results_announced = get_contest_status()
+    user_data, _, contest = await load_interaction_context(user_id)
+    contest_status, results_announced = contest_state(contest)
     
     # Cancella il messaggio da copiare se presente
-    if user_id in pending_share_messages:
-        message_id = pending_share_messages[user_id]
+    # (l'entry viene rimossa comunque per evitare accumulo)
+    message_id = await pending_share_messages.pop(user_id)
+    if message_id:
         try:
             await context.bot.delete_message(
                 chat_id=query.message.chat_id, 
                 message_id=message_id
             )
-            del pending_share_messages[user_id]
             print(f"🧹 Messaggio condivisione cancellato per utente {user_id}")
         except Exception as e:
             print(f"⚠️ Impossibile cancellare messaggio condivisione: {e}")
-            # Rimuovi comunque l'entry per evitare accumulo
-            del pending_share_messages[user_id]
     
-    user_data = get_user(user_id)
+    if not user_data:
+        await query.edit_message_text("❌ Non sei registrato. Usa /start per registrarti.")
+        return
     
     # Se contest completato, mostra menu semplificato
     if contest_status == 'completed':
-        keyboard = [[InlineKeyboardButton("📊 Le mie statistiche", callback_data="show_stats")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        message = f"🏁 Contest {contest['contest_name']} terminato\n\n"
-        message += get_full_prize_text(contest) + "\n\n"
-        message += f"Grazie per la partecipazione!"
-        
-        await query.edit_message_text(message, reply_markup=reply_markup)
+        await query.edit_message_text(get_templates(contest).completed_menu_text, reply_markup=STATS_ONLY_KEYBOARD)
         return
     
     # Menu normale per contest attivo con pulsante condivisione
-    referral_link = f"https://t.me/{context.bot.username}?start={user_data['referral_code']}"
+    message = get_templates(contest).welcome_back_text(user_data['total_invites'])
     
-    keyboard = [
-        [InlineKeyboardButton("📊 Le mie statistiche", callback_data="show_stats")],
-        [InlineKeyboardButton("🚀 Condividi il mio link", callback_data="share_link")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(message, reply_markup=MAIN_MENU_KEYBOARD)
+
+async def track_channel_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ledger iscrizioni: registra ingressi e uscite dal canale del contest in tempo reale"""
+    change = update.chat_member
+    contest = await get_current_contest()
+    if not contest:
+        return
+    
+    # channel_id può essere l'id numerico o l'@username del canale
+    chat = change.chat
+    if str(contest['channel_id']) not in (str(chat.id), f"@{chat.username}"):
+        return
     
-    message = f"🎉 Bentornato al Contest {contest['contest_name']}! 🎉\n\n"
-    message += f"📜 Il regolamento è semplicissimo: vince chi porta più iscritti al canale Telegram di Vivio!\n\n"
-    message += get_full_prize_text(contest) + "\n"
-    message += f"💥 Persone invitate: {user_data['total_invites']}\n\n"
-    message += f"👉 Condividi il tuo link d'invito tramite il tasto qui sotto con tutti i tuoi amici… e che vinca il migliore! 🚀"
+    user_id = change.new_chat_member.user.id
+    is_member = change.new_chat_member.status in MEMBER_STATUSES
+    await membership.record(contest['channel_id'], user_id, is_member)
+    await set_referral_membership(user_id, is_member, change.date)
     
-    await query.edit_message_text(message, reply_markup=reply_markup)
+    if not is_member:
+        print(f"🚪 Utente {user_id} uscito dal canale")
 
 # COMANDI ADMIN
 async def admin_end_contest(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -599,17 +501,17 @@ async def admin_end_contest(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Solo gli admin possono usare questo comando")
         return
     
-    contest_status, _ = get_contest_status()
+    contest_status, _ = await get_contest_status()
     if contest_status != 'active':
         await update.message.reply_text(f"❌ Contest non attivo (stato: {contest_status})")
         return
     
     # Avvia verifica finale
-    if start_final_verification():
+    if await start_final_verification():
         await update.message.reply_text("🔍 Verifica finale avviata manualmente...")
         
         # Esegui verifica in background
-        asyncio.create_task(run_final_verification(context.bot, user_id))
+        asyncio.create_task(run_final_verification(context.bot_data[BULK_BOT_KEY], user_id))
     else:
         await update.message.reply_text("❌ Errore nell'avvio della verifica finale")
 
@@ -620,7 +522,7 @@ async def admin_announce_results(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("❌ Solo gli admin possono usare questo comando")
         return
     
-    contest_status, results_announced = get_contest_status()
+    contest_status, results_announced = await get_contest_status()
     if contest_status != 'completed':
         await update.message.reply_text(f"❌ Contest non completato (stato: {contest_status})")
         return
@@ -629,54 +531,182 @@ async def admin_announce_results(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("ℹ️ Risultati già annunciati")
         return
     
-    if announce_results():
+    if await announce_results():
         await update.message.reply_text("✅ Risultati annunciati! Avvio broadcast...")
         
         # Avvia broadcast automatico
-        contest = get_current_contest()
-        asyncio.create_task(broadcast_contest_results(context.bot, user_id, contest['contest_name']))
+        contest = await get_current_contest()
+        asyncio.create_task(broadcast_contest_results(context.bot_data[BULK_BOT_KEY], user_id, contest['contest_name']))
     else:
         await update.message.reply_text("❌ Errore nell'annuncio risultati")
 
+async def admin_broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ Solo gli admin possono usare questo comando")
+        return
+    
+    job = await get_latest_broadcast_job()
+    if not job:
+        await update.message.reply_text("ℹ️ Nessun broadcast eseguito")
+        return
+    
+    progress = await get_broadcast_progress(job['id'])
+    if progress is None:
+        await update.message.reply_text("❌ Errore lettura avanzamento broadcast")
+        return
+    await update.message.reply_text(format_job_progress(job, progress))
+
+async def admin_flood_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ Solo gli admin possono usare questo comando")
+        return
+    
+    await update.message.reply_text(callback_guard.format_stats())
+
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Comando testuale di backup
     await show_stats_callback(update, context)
 
-def main():
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+def build_application(webhook=False, request=None, rate_limited=True):
+    """Crea l'Application con tutti gli handler registrati
+    
+    `request` sostituisce il client HTTP della Bot API (es. Telegram finto
+    in benchmark.py); con `rate_limited=False` i limiti del governor non
+    vengono applicati.
+    """
+    # Ogni chiamata Bot API viene misurata per metodo (/metrics)
+    if request is None:
+        request = InstrumentedRequest(connection_pool_size=BOT_API_POOL_SIZE)
+    # Gli handler sono asincroni e non bloccanti: gli update vengono processati in parallelo.
+    # Le risposte agli utenti passano dalla corsia interattiva del governor
+    builder = (Application.builder().token(TELEGRAM_BOT_TOKEN)
+               .base_url(TELEGRAM_API_BASE_URL)
+               .request(request)
+               .concurrent_updates(CONCURRENT_UPDATES))
+    if rate_limited:
+        builder = builder.rate_limiter(governor.lane(INTERACTIVE))
+    if webhook:
+        # Gli update arrivano dal nostro server HTTP, niente Updater/polling
+        builder = builder.updater(None)
+    app = builder.build()
+    
+    # Job massivi su un Bot dedicato: corsia bulk e pool di connessioni separato
+    bulk_bot = ExtBot(TELEGRAM_BOT_TOKEN, base_url=TELEGRAM_API_BASE_URL,
+                      request=InstrumentedRequest(connection_pool_size=BULK_POOL_SIZE),
+                      rate_limiter=governor.lane(BULK) if rate_limited else None)
+    app.bot_data[BULK_BOT_KEY] = bulk_bot
     
     # Comandi utente
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("start", timed_handler(start)))
+    app.add_handler(CommandHandler("stats", timed_handler(stats)))
     
     # Comandi admin
-    app.add_handler(CommandHandler("admin_end_contest", admin_end_contest))
-    app.add_handler(CommandHandler("admin_announce_results", admin_announce_results))
-    
-    # Callback handlers
-    app.add_handler(CallbackQueryHandler(verify_subscription_callback, pattern="verify_subscription"))
-    app.add_handler(CallbackQueryHandler(verify_direct_subscription_callback, pattern="verify_direct_subscription"))
-    app.add_handler(CallbackQueryHandler(show_stats_callback, pattern="show_stats"))
-    app.add_handler(CallbackQueryHandler(share_link_callback, pattern="share_link"))
-    app.add_handler(CallbackQueryHandler(back_to_main_callback, pattern="back_to_main"))
+    app.add_handler(CommandHandler("admin_end_contest", timed_handler(admin_end_contest)))
+    app.add_handler(CommandHandler("admin_announce_results", timed_handler(admin_announce_results)))
+    app.add_handler(CommandHandler("admin_broadcast_status", timed_handler(admin_broadcast_status)))
+    app.add_handler(CommandHandler("admin_flood_stats", timed_handler(admin_flood_stats)))
+    
+    # Callback handlers (tap ripetuti collassati in un'unica esecuzione). PARTECIPA
+    # scarta solo i tap durante la verifica: dopo "non risulti iscritto" l'utente riprova subito
+    app.add_handler(CallbackQueryHandler(callback_guard(timed_handler(verify_subscription_callback), debounce=False), pattern="verify_subscription"))
+    app.add_handler(CallbackQueryHandler(callback_guard(timed_handler(verify_direct_subscription_callback), debounce=False), pattern="verify_direct_subscription"))
+    app.add_handler(CallbackQueryHandler(callback_guard(timed_handler(show_stats_callback)), pattern="show_stats"))
+    app.add_handler(CallbackQueryHandler(callback_guard(timed_handler(share_link_callback)), pattern="share_link"))
+    app.add_handler(CallbackQueryHandler(callback_guard(timed_handler(back_to_main_callback)), pattern="back_to_main"))
+    
+    # Ingressi/uscite dal canale (il bot deve esserne admin)
+    app.add_handler(ChatMemberHandler(timed_handler(track_channel_membership), ChatMemberHandler.CHAT_MEMBER))
     
     # Funzione per avviare il controllo periodico dopo che il bot è pronto
+    # In polling il server HTTP serve solo health check e /metrics
+    metrics_server = None
+    
     async def post_init(application):
+        nonlocal metrics_server
+        if not webhook:
+            metrics_server = make_web_app(application, WEBHOOK_SECRET, webhook=False).listen(PORT)
+            print(f"📈 Metriche disponibili su porta {PORT} (/metrics)")
+        
+        await bulk_bot.initialize()
+        
+        # Classifica live: caricamento iniziale e riallineamento periodico
+        asyncio.create_task(leaderboard_resync_loop())
+        
+        # Con più repliche i job di background girano solo sulla prima
+        if SHARD_INDEX != 0:
+            return
+        
         if ADMIN_IDS:
-            asyncio.create_task(periodic_contest_check(application.bot, ADMIN_IDS[0]))
-            print("📅 Controllo periodico contest attivato")
+            # Avvio e chiusura del contest alle date previste
+            asyncio.create_task(contest_lifecycle_loop(bulk_bot, ADMIN_IDS[0]))
+            print("📅 Scheduler contest attivato")
+            # Riprende un'eventuale verifica finale interrotta da un riavvio
+            asyncio.create_task(resume_final_verification(bulk_bot, ADMIN_IDS[0]))
+        # Riprende i broadcast interrotti senza rimandare i messaggi già inviati
+        asyncio.create_task(resume_broadcast_jobs(bulk_bot))
+        # Ricontrollo a campione delle iscrizioni durante il contest (budget limitato)
+        asyncio.create_task(reverification_loop(bulk_bot))
+    
+    # Chiude il pool di connessioni Supabase allo spegnimento
+    async def post_shutdown(application):
+        if metrics_server:
+            metrics_server.stop()
+        await bulk_bot.shutdown()
+        await close_client()
     
     # Aggiungi post_init callback
     app.post_init = post_init
+    app.post_shutdown = post_shutdown
+    
+    return app
+
+async def run_webhook(app):
+    """Riceve gli update via webhook sul server HTTP locale (PORT)"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL non configurato: necessario in modalità webhook")
+    
+    server = make_web_app(app, WEBHOOK_SECRET, SHARD_URLS, SHARD_INDEX).listen(PORT)
     
-    # Railway usa PORT environment variable
-    import os
-    port = int(os.environ.get("PORT", 8000))
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
     
+    try:
+        async with app:
+            # Gli update arrivati durante un redeploy restano in coda su Telegram
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=False
+            )
+            await app.post_init(app)
+            await app.start()
+            print(f"🌐 Webhook attivo su porta {PORT}")
+            
+            try:
+                await stop_event.wait()
+            finally:
+                await app.stop()
+    finally:
+        server.stop()
+        await app.post_shutdown(app)
+
+def main():
     print("🤖 Bot avviato su Railway...")
     
-    # Per Railway, usa polling invece di webhooks
-    app.run_polling(drop_pending_updates=True)
+    if BOT_MODE == 'webhook':
+        app = build_application(webhook=True)
+        asyncio.run(run_webhook(app))
+    else:
+        app = build_application()
+        # Nessun update scartato all'avvio: i /start arrivati durante il redeploy vengono gestiti
+        app.run_polling(allowed_updates=ALLOWED_UPDATES, drop_pending_updates=False)
 
 if __name__ == "__main__":
-    main()
+    main()
\ No newline at end of file
@@ -1,45 +1,229 @@
 import asyncio
-from database import get_all_users, get_user_count
+import random
+import time
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+from database import (create_broadcast_job, get_broadcast_job, get_running_broadcast_jobs,
+                     iter_pending_recipients, set_recipients_status, get_broadcast_progress,
+                     complete_broadcast_job)
+from ratelimit import TokenBucket
+from batching import OutcomeBuffer
+from metrics import FLOOD_WAITS, RETRIES
 
-async def broadcast_message(bot, message_text, admin_id):
-    """Invia messaggio broadcast a tutti gli utenti"""
+# Limite globale Bot API ~30 messaggi/s: un solo bucket condiviso dai worker
+BROADCAST_RATE = 28
+BROADCAST_WORKERS = 30
+BROADCAST_MAX_ATTEMPTS = 5
+# Stati di consegna salvati a blocchi: dopo un crash si rimanda al massimo un blocco
+STATUS_BATCH_SIZE = 100
+STATUS_FLUSH_INTERVAL = 2
+# Intervallo (secondi) tra gli aggiornamenti di avanzamento all'admin
+PROGRESS_INTERVAL = 30
+
+# Job in esecuzione in questo processo (evita doppi invii sulla stessa lista)
+_running_jobs = set()
+
+async def send_with_retry(bot, chat_id, bucket, text, reply_markup=None, max_attempts=BROADCAST_MAX_ATTEMPTS):
+    """Invia un messaggio rispettando il rate limit: 'sent', 'blocked' o 'failed'"""
+    for attempt in range(1, max_attempts + 1):
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text, reply_markup=reply_markup)
+            return 'sent'
+        except RetryAfter as e:
+            # Flood control globale: ferma tutti i worker
+            print(f"⏳ RetryAfter {e.retry_after}s durante broadcast")
+            FLOOD_WAITS.inc(operation='broadcast')
+            bucket.pause(e.retry_after)
+        except Forbidden:
+            # Bot bloccato o account disattivato: inutile riprovare
+            return 'blocked'
+        except BadRequest as e:
+            print(f"❌ Errore invio a {chat_id}: {e}")
+            return 'failed'
+        except NetworkError as e:
+            # Errore transitorio: backoff esponenziale solo per questa chat
+            print(f"⚠️ Errore transitorio invio a {chat_id} (tentativo {attempt}): {e}")
+            RETRIES.inc(operation='broadcast')
+            await asyncio.sleep(min(2 ** attempt, 60) + random.random())
     
-    users = get_all_users()
-    total_users = len(users)
+    return 'failed'
+
+async def run_broadcast(bot, recipients, text, reply_markup=None, total=None, on_result=None,
+                        on_progress=None, rate=BROADCAST_RATE, workers=BROADCAST_WORKERS):
+    """Invia lo stesso messaggio a tutte le chat con un pool di worker
     
-    if total_users == 0:
-        await bot.send_message(admin_id, "❌ Nessun utente da contattare")
-        return
+    `recipients` è un async iterable di chat_id, consumato man mano. Tutti i
+    worker condividono un token bucket. `on_result(chat_id, result)` viene
+    awaited per ogni esito e `on_progress(stats)` ogni PROGRESS_INTERVAL
+    secondi. Restituisce le statistiche finali (sent, blocked, failed,
+    elapsed, rate).
+    """
+    bucket = TokenBucket(rate)
+    queue = asyncio.Queue(maxsize=workers * 4)
     
-    print(f"📢 Avvio broadcast per {total_users} utenti...")
-    await bot.send_message(admin_id, f"📢 Invio messaggio a {total_users} utenti...")
+    stats = {'total': total, 'sent': 0, 'blocked': 0, 'failed': 0}
+    started = time.monotonic()
+    last_progress = started
     
-    sent_count = 0
-    failed_count = 0
+    def snapshot():
+        elapsed = time.monotonic() - started
+        return {**stats, 'elapsed': elapsed, 'rate': stats['sent'] / elapsed if elapsed > 0 else 0}
     
-    for i, user in enumerate(users):
+    async def producer():
         try:
-            await bot.send_message(user['telegram_id'], message_text)
-            sent_count += 1
+            async for chat_id in recipients:
+                await queue.put(chat_id)
+        finally:
+            for _ in range(workers):
+                await queue.put(None)
+    
+    async def worker():
+        nonlocal last_progress
+        while True:
+            chat_id = await queue.get()
+            if chat_id is None:
+                return
+            result = await send_with_retry(bot, chat_id, bucket, text, reply_markup)
+            stats[result] += 1
             
-            # Progress ogni 100 messaggi
-            if (i + 1) % 100 == 0:
-                progress_msg = f"📊 Progress: {i + 1}/{total_users} - Inviati: {sent_count}, Falliti: {failed_count}"
-                await bot.send_message(admin_id, progress_msg)
-                print(progress_msg)
+            if on_result:
+                try:
+                    await on_result(chat_id, result)
+                except Exception as e:
+                    print(f"❌ Errore salvataggio esito {chat_id}: {e}")
             
-            # Rate limiting: pausa ogni 30 messaggi
-            if (i + 1) % 30 == 0:
-                await asyncio.sleep(1)
-                
-        except Exception as e:
-            failed_count += 1
-            print(f"❌ Errore invio a {user['telegram_id']}: {e}")
+            if on_progress and time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                try:
+                    await on_progress(snapshot())
+                except Exception as e:
+                    print(f"❌ Errore notifica progress: {e}")
+    
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    producer_task = asyncio.create_task(producer())
+    try:
+        await asyncio.gather(producer_task, *tasks)
+    finally:
+        producer_task.cancel()
+        for task in tasks:
+            task.cancel()
     
-    # Risultato finale
-    final_msg = f"✅ Broadcast completato!\n\n📊 Statistiche:\n👥 Totale utenti: {total_users}\n✅ Inviati: {sent_count}\n❌ Falliti: {failed_count}"
-    await bot.send_message(admin_id, final_msg)
-    print(f"✅ Broadcast completato: {sent_count}/{total_users} inviati")
+    return snapshot()
+
+def format_progress(stats):
+    done = stats['sent'] + stats['blocked'] + stats['failed']
+    return (f"📊 Progress: {done}/{stats['total']} - Inviati: {stats['sent']}, "
+            f"Falliti: {stats['failed'] + stats['blocked']} ({stats['rate']:.1f} msg/s)")
+
+def format_job_progress(job, progress):
+    """Riepilogo di un job per l'admin, dai conteggi salvati nel database"""
+    total = sum(progress.values())
+    sent = progress.get('sent', 0)
+    failed = progress.get('failed', 0) + progress.get('blocked', 0)
+    success_rate = (sent / (sent + failed) * 100) if sent + failed > 0 else 0
+    
+    message = f"📢 Broadcast #{job['id']} ({job['kind']}) - {job['status']}\n\n"
+    message += f"👥 Totale utenti: {total}\n"
+    message += f"⏳ Da inviare: {progress.get('pending', 0)}\n"
+    message += f"✅ Inviati: {sent}\n"
+    message += f"🚫 Bloccato il bot: {progress.get('blocked', 0)}\n"
+    message += f"❌ Falliti: {progress.get('failed', 0)}\n"
+    message += f"📈 Tasso successo: {success_rate:.1f}%"
+    return message
+
+async def run_broadcast_job(bot, job):
+    """Esegue (o riprende) un job di broadcast inviando solo ai destinatari pending"""
+    job_id = job['id']
+    admin_id = job['admin_id']
+    
+    if job_id in _running_jobs:
+        print(f"ℹ️ Broadcast #{job_id} già in corso")
+        return False
+    
+    _running_jobs.add(job_id)
+    try:
+        progress = await get_broadcast_progress(job_id)
+        if progress is None:
+            # Il job resta 'running' e verrà ripreso al prossimo avvio
+            await bot.send_message(admin_id, f"❌ Broadcast #{job_id}: errore lettura destinatari, verrà ripreso al prossimo avvio.")
+            return False
+        pending = progress.get('pending', 0)
+        reply_markup = InlineKeyboardMarkup.de_json(job['reply_markup'], bot) if job['reply_markup'] else None
+        
+        print(f"📢 Broadcast #{job_id}: {pending} destinatari da contattare...")
+        await bot.send_message(admin_id, f"📢 Broadcast #{job_id}: invio a {pending} utenti...")
+        
+        async def write_statuses(status, telegram_ids):
+            return await set_recipients_status(job_id, telegram_ids, status)
+        
+        statuses = OutcomeBuffer(write_statuses, STATUS_BATCH_SIZE, STATUS_FLUSH_INTERVAL)
+        
+        async def on_progress(stats):
+            progress_msg = format_progress(stats)
+            await bot.send_message(admin_id, progress_msg)
+            print(progress_msg)
+        
+        try:
+            stats = await run_broadcast(bot, iter_pending_recipients(job_id), job['message_text'],
+                                        reply_markup=reply_markup, total=pending,
+                                        on_result=statuses.add, on_progress=on_progress)
+        finally:
+            # Salva gli ultimi esiti anche se il broadcast si interrompe
+            saved = await statuses.flush()
+        
+        if not saved:
+            await bot.send_message(admin_id, f"⚠️ Broadcast #{job_id}: esiti non salvati, verrà ripreso al prossimo avvio.")
+            return False
+        
+        await complete_broadcast_job(job_id)
+        job = {**job, 'status': 'completed'}
+        
+        # Risultato finale (include gli invii di eventuali esecuzioni precedenti)
+        final_msg = "✅ Broadcast completato!\n\n"
+        progress = await get_broadcast_progress(job_id)
+        if progress is not None:
+            final_msg += format_job_progress(job, progress)
+        final_msg += f"\n⚡ Velocità: {stats['rate']:.1f} msg/s in {stats['elapsed']:.0f}s"
+        await bot.send_message(admin_id, final_msg)
+        print(f"✅ Broadcast #{job_id} completato: {stats['sent']} inviati ({stats['rate']:.1f} msg/s)")
+        return True
+    except Exception as e:
+        print(f"❌ Errore broadcast #{job_id}: {e}")
+        return False
+    finally:
+        _running_jobs.discard(job_id)
+
+async def resume_broadcast_jobs(bot):
+    """Riprende i broadcast interrotti da un riavvio, senza rimandare i messaggi già inviati"""
+    for job in await get_running_broadcast_jobs():
+        print(f"♻️ Ripresa broadcast #{job['id']}...")
+        await run_broadcast_job(bot, job)
+
+async def start_broadcast_job(bot, kind, message_text, admin_id, reply_markup=None):
+    """Crea un job di broadcast persistente e lo esegue"""
+    job_id = await create_broadcast_job(kind, message_text, reply_markup.to_dict() if reply_markup else None, admin_id)
+    job = await get_broadcast_job(job_id) if job_id else None
+    
+    if not job:
+        await bot.send_message(admin_id, "❌ Errore nella creazione del broadcast")
+        return False
+    
+    progress = await get_broadcast_progress(job_id)
+    if progress is None:
+        await bot.send_message(admin_id, f"❌ Broadcast #{job_id}: errore lettura destinatari, verrà ripreso al prossimo avvio.")
+        return False
+    
+    if job['status'] == 'running' and not progress.get('pending'):
+        await complete_broadcast_job(job_id)
+        await bot.send_message(admin_id, "❌ Nessun utente da contattare")
+        return False
+    
+    return await run_broadcast_job(bot, job)
+
+async def broadcast_message(bot, message_text, admin_id):
+    """Invia messaggio broadcast a tutti gli utenti"""
+    return await start_broadcast_job(bot, 'message', message_text, admin_id)
 
 async def broadcast_contest_results(bot, admin_id, contest_name):
    """Broadcast specifico per annuncio risultati contest"""
@@ -49,56 +233,8 @@ async def broadcast_contest_results(bot, admin_id, contest_name):
    message += f"Usa il bottone qui sotto per vedere la tua posizione finale:"
    
    # Aggiungi bottone per vedere risultati
-   from telegram import InlineKeyboardButton, InlineKeyboardMarkup
    keyboard = [[InlineKeyboardButton("📊 I miei risultati", callback_data="show_stats")]]
    reply_markup = InlineKeyboardMarkup(keyboard)
    
    # Broadcast con bottone
-   users = get_all_users()
-   total_users = len(users)
-   
-   if total_users == 0:
-       await bot.send_message(admin_id, "❌ Nessun utente da contattare per il broadcast")
-       return
-   
-   sent_count = 0
-   failed_count = 0
-   
-   await bot.send_message(admin_id, f"📢 Invio annuncio risultati a {total_users} utenti...")
-   
-   for i, user in enumerate(users):
-       try:
-           await bot.send_message(
-               user['telegram_id'], 
-               message, 
-               reply_markup=reply_markup
-           )
-           sent_count += 1
-           
-           # Progress ogni 100 utenti
-           if (i + 1) % 100 == 0:
-               progress_msg = f"📊 Progress: {i + 1}/{total_users} - Inviati: {sent_count}, Falliti: {failed_count}"
-               await bot.send_message(admin_id, progress_msg)
-               print(progress_msg)
-           
-           # Rate limiting: pausa ogni 30 messaggi
-           if (i + 1) % 30 == 0:
-               await asyncio.sleep(1)
-               
-       except Exception as e:
-           failed_count += 1
-           print(f"❌ Errore broadcast a {user['telegram_id']}: {e}")
-   
-   # Risultato finale con fix division by zero
-   total_sent_failed = sent_count + failed_count
-   success_rate = (sent_count / total_sent_failed * 100) if total_sent_failed > 0 else 0
-   
-   final_msg = f"✅ Broadcast completato!\n\n"
-   final_msg += f"📊 Statistiche broadcast:\n"
-   final_msg += f"👥 Totale utenti: {total_users}\n"
-   final_msg += f"✅ Inviati: {sent_count}\n"
-   final_msg += f"❌ Falliti: {failed_count}\n"
-   final_msg += f"📈 Tasso successo: {success_rate:.1f}%"
-   
-   await bot.send_message(admin_id, final_msg)
-   print(f"✅ Broadcast completato: {sent_count}/{total_users} inviati")
\ No newline at end of file
+   return await start_broadcast_job(bot, 'contest_results', message, admin_id, reply_markup=reply_markup)
\ No newline at end of file
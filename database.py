@@ -1,12 +1,72 @@
-from supabase import create_client, Client
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+import httpx
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
+from postgrest.types import ReturnMethod
 from config import SUPABASE_URL, SUPABASE_KEY
+from leaderboard import leaderboard
+from referral_codes import referral_codes
+from metrics import DATABASE_LATENCY, instrument_module, count_supabase_response
 
-# Connessione Supabase
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Pool di connessioni HTTP condiviso da tutte le query (keep-alive verso Supabase)
+SUPABASE_MAX_CONNECTIONS = 50
+SUPABASE_MAX_KEEPALIVE = 20
+SUPABASE_TIMEOUT = 10.0
+# Righe per pagina nelle letture paginate (sotto il limite righe di PostgREST)
+PAGE_SIZE = 1000
 
-def test_connection():
+# Snapshot del contest attivo, riletto al massimo ogni CONTEST_CACHE_TTL secondi
+CONTEST_CACHE_TTL = 10
+_contest_cache = None
+_contest_cache_expires = 0.0
+_contest_cache_lock = asyncio.Lock()
+# Incrementata a ogni invalidazione: una lettura iniziata prima non va messa in cache
+_contest_cache_generation = 0
+# Notificati a ogni invalidazione (es. scheduler del ciclo di vita del contest)
+_contest_change_listeners = []
+
+# Connessione Supabase asincrona, creata al primo utilizzo nel loop del bot
+_client: AsyncClient | None = None
+_client_lock = asyncio.Lock()
+
+async def get_client() -> AsyncClient:
+    """Restituisce il client Supabase asincrono (creato una sola volta)"""
+    global _client
+    if _client is None:
+        async with _client_lock:
+            if _client is None:
+                http_client = httpx.AsyncClient(
+                    timeout=SUPABASE_TIMEOUT,
+                    limits=httpx.Limits(
+                        max_connections=SUPABASE_MAX_CONNECTIONS,
+                        max_keepalive_connections=SUPABASE_MAX_KEEPALIVE
+                    ),
+                    follow_redirects=True,
+                    event_hooks={'response': [count_supabase_response]}
+                )
+                _client = await acreate_client(
+                    SUPABASE_URL, SUPABASE_KEY,
+                    options=AsyncClientOptions(httpx_client=http_client)
+                )
+    return _client
+
+def set_client(client):
+    """Sostituisce il client Supabase (es. client su database finto nei benchmark)"""
+    global _client
+    _client = client
+
+async def close_client():
+    """Chiude le connessioni del pool HTTP (allo shutdown del bot)"""
+    global _client
+    if _client is not None:
+        await _client.postgrest.aclose()
+        _client = None
+
+async def test_connection():
     try:
-        result = supabase.table('contest_settings').select("*").execute()
+        supabase = await get_client()
+        result = await supabase.table('contest_settings').select("*").execute()
         print("✅ Connessione Supabase OK!")
         print(f"📊 Trovati {len(result.data)} contest nel database")
         return True
@@ -14,27 +74,57 @@ def test_connection():
         print(f"❌ Errore connessione: {e}")
         return False
 
-def get_current_contest():
-    """Ottieni il contest attivo"""
-    try:
-        result = supabase.table('contest_settings').select("*").eq('is_active', True).execute()
-        return result.data[0] if result.data else None
-    except Exception as e:
-        print(f"❌ Errore lettura contest: {e}")
-        return None
+def on_contest_change(listener):
+    """Registra una funzione chiamata a ogni cambio di stato del contest"""
+    _contest_change_listeners.append(listener)
 
-def user_exists(telegram_id):
+def invalidate_contest_cache():
+    """Forza la rilettura del contest alla prossima richiesta (dopo ogni cambio di stato)"""
+    global _contest_cache_expires, _contest_cache_generation
+    _contest_cache_expires = 0.0
+    _contest_cache_generation += 1
+    for listener in _contest_change_listeners:
+        listener()
+
+async def get_current_contest():
+    """Ottieni il contest attivo (snapshot in cache per CONTEST_CACHE_TTL secondi)"""
+    global _contest_cache, _contest_cache_expires
+    if time.monotonic() < _contest_cache_expires:
+        return _contest_cache
+    
+    # Una sola query anche con molti handler concorrenti a cache scaduta
+    async with _contest_cache_lock:
+        if time.monotonic() < _contest_cache_expires:
+            return _contest_cache
+        try:
+            supabase = await get_client()
+            while True:
+                generation = _contest_cache_generation
+                result = await supabase.table('contest_settings').select("*").eq('is_active', True).execute()
+                # Invalidata durante la lettura: la riga potrebbe essere già vecchia, si rilegge
+                if generation == _contest_cache_generation:
+                    break
+            _contest_cache = result.data[0] if result.data else None
+            _contest_cache_expires = time.monotonic() + CONTEST_CACHE_TTL
+            return _contest_cache
+        except Exception as e:
+            print(f"❌ Errore lettura contest: {e}")
+            return None
+
+async def user_exists(telegram_id):
     """Controlla se utente esiste già"""
     try:
-        result = supabase.table('users').select("telegram_id").eq('telegram_id', telegram_id).execute()
+        supabase = await get_client()
+        result = await supabase.table('users').select("telegram_id").eq('telegram_id', telegram_id).execute()
         return len(result.data) > 0
     except Exception as e:
         print(f"❌ Errore controllo utente: {e}")
         return False
 
-def create_user(telegram_id, username, first_name, referred_by=None):
+async def create_user(telegram_id, username, first_name, referred_by=None):
     """Crea nuovo utente"""
     try:
+        supabase = await get_client()
         referral_code = f"REF_{telegram_id}"
         
         user_data = {
@@ -45,68 +135,88 @@ def create_user(telegram_id, username, first_name, referred_by=None):
             'referred_by': referred_by
         }
         
-        result = supabase.table('users').insert(user_data).execute()
+        result = await supabase.table('users').insert(user_data).execute()
+        leaderboard.set_user(telegram_id, first_name)
+        referral_codes.add(referral_code)
         print(f"✅ Utente creato: {telegram_id}")
         return result.data[0] if result.data else None
     except Exception as e:
         print(f"❌ Errore creazione utente: {e}")
         return None
 
-def get_user(telegram_id):
+async def get_user(telegram_id):
     """Ottieni dati utente"""
     try:
-        result = supabase.table('users').select("*").eq('telegram_id', telegram_id).execute()
+        supabase = await get_client()
+        result = await supabase.table('users').select("*").eq('telegram_id', telegram_id).execute()
         return result.data[0] if result.data else None
     except Exception as e:
         print(f"❌ Errore lettura utente: {e}")
         return None
 
-def create_pending_referral(referrer_id, new_user_id):
+async def create_pending_referral(referrer_id, new_user_id):
     """Crea referral in stato pending"""
     try:
+        supabase = await get_client()
         referral_data = {
             'referrer_telegram_id': referrer_id,
             'referred_telegram_id': new_user_id,
             'status': 'pending'
         }
         
-        result = supabase.table('referrals').insert(referral_data).execute()
+        result = await supabase.table('referrals').insert(referral_data).execute()
         print(f"✅ Referral pending creato: {referrer_id} → {new_user_id}")
         return result.data[0] if result.data else None
     except Exception as e:
         print(f"❌ Errore creazione referral: {e}")
         return None
 
-def get_user_by_referral_code(referral_code):
-    """Trova utente dal suo codice referral"""
+async def register_via_referral(telegram_id, username, first_name, referral_code):
+    """Registra un utente arrivato da link di invito (RPC atomica, un solo round-trip)
+    
+    Restituisce (esito, referrer): esito 'registered', 'already_registered'
+    o 'invalid_code'; referrer ({telegram_id, first_name}) solo se registrato.
+    (None, None) in caso di errore.
+    """
     try:
-        result = supabase.table('users').select("*").eq('referral_code', referral_code).execute()
-        return result.data[0] if result.data else None
+        supabase = await get_client()
+        result = await supabase.rpc('register_via_referral', {
+            'p_telegram_id': telegram_id,
+            'p_username': username,
+            'p_first_name': first_name,
+            'p_referral_code': referral_code
+        }).execute()
+        
+        data = result.data or {}
+        outcome = data.get('status')
+        referrer = data.get('referrer')
+        if outcome == 'registered':
+            leaderboard.set_user(telegram_id, first_name)
+            referral_codes.add(f"REF_{telegram_id}")
+            referral_codes.add(referral_code)
+            print(f"✅ Utente creato con referral pending: {referrer['telegram_id']} → {telegram_id}")
+        elif outcome == 'invalid_code':
+            await referral_codes.mark_unknown(referral_code)
+        return outcome, referrer
     except Exception as e:
-        print(f"❌ Errore ricerca referral code: {e}")
-        return None
+        print(f"❌ Errore registrazione tramite referral: {e}")
+        return None, None
 
-def complete_referral(referrer_id, new_user_id):
-    """Completa referral e incrementa counter"""
+async def complete_referral(referrer_id, new_user_id):
+    """Completa referral e incrementa counter (RPC atomica e idempotente)"""
     try:
-        # Aggiorna il nuovo utente per indicare chi l'ha riferito
-        supabase.table('users').update({
-            'referred_by': referrer_id
-        }).eq('telegram_id', new_user_id).execute()
-        
-        # Aggiorna referral da pending a completed
-        supabase.table('referrals').update({
-            'status': 'completed',
-            'completed_at': 'NOW()'
-        }).eq('referrer_telegram_id', referrer_id).eq('referred_telegram_id', new_user_id).execute()
-        
-        # Incrementa total_invites del referrer
-        current_user = supabase.table('users').select('total_invites').eq('telegram_id', referrer_id).execute()
-        new_count = current_user.data[0]['total_invites'] + 1
+        supabase = await get_client()
+        result = await supabase.rpc('complete_referral', {
+            'p_referrer_id': referrer_id,
+            'p_referred_id': new_user_id
+        }).execute()
+        
+        if result.data == 'not_found':
+            print(f"❌ Referral non trovato: {referrer_id} → {new_user_id}")
+            return False
         
-        supabase.table('users').update({
-            'total_invites': new_count
-        }).eq('telegram_id', referrer_id).execute()
+        if result.data == 'completed':
+            leaderboard.add_invites(referrer_id, 1)
         
         print(f"✅ Referral completato: {referrer_id} → {new_user_id}")
         return True
@@ -114,33 +224,54 @@ def complete_referral(referrer_id, new_user_id):
         print(f"❌ Errore completamento referral: {e}")
         return False
 
-def get_pending_referral(referred_user_id):
+async def get_pending_referral(referred_user_id):
     """Trova referral pending per un utente"""
     try:
-        result = supabase.table('referrals').select("*").eq('referred_telegram_id', referred_user_id).eq('status', 'pending').execute()
+        supabase = await get_client()
+        result = await supabase.table('referrals').select("*").eq('referred_telegram_id', referred_user_id).eq('status', 'pending').execute()
         return result.data[0] if result.data else None
     except Exception as e:
         print(f"❌ Errore ricerca referral pending: {e}")
         return None
 
-def get_contest_status():
-    """Ottieni stato attuale del contest"""
-    try:
-        result = supabase.table('contest_settings').select("status, results_announced").eq('is_active', True).execute()
-        if result.data:
-            return result.data[0]['status'], result.data[0]['results_announced']
-        return None, False
-    except Exception as e:
-        print(f"❌ Errore lettura stato contest: {e}")
-        return None, False
+async def load_interaction_context(telegram_id):
+    """Utente, referral pending e contest in un solo round-trip
+    
+    Restituisce (user, pending_referral, contest): user è None se l'utente
+    non è registrato o in caso di errore. Il contest viene dalla cache.
+    """
+    async def fetch_user_context():
+        try:
+            supabase = await get_client()
+            result = await supabase.rpc('load_interaction_context', {'p_telegram_id': telegram_id}).execute()
+            data = result.data or {}
+            return data.get('user'), data.get('pending_referral')
+        except Exception as e:
+            print(f"❌ Errore lettura contesto utente: {e}")
+            return None, None
+    
+    (user, pending_referral), contest = await asyncio.gather(fetch_user_context(), get_current_contest())
+    return user, pending_referral, contest
+
+def contest_state(contest):
+    """(status, results_announced) di uno snapshot del contest"""
+    if contest:
+        return contest['status'], contest['results_announced']
+    return None, False
 
-def start_final_verification():
+async def get_contest_status():
+    """Ottieni stato attuale del contest (dallo snapshot in cache)"""
+    return contest_state(await get_current_contest())
+
+async def start_final_verification():
     """Avvia processo di verifica finale"""
     try:
-        supabase.table('contest_settings').update({
+        supabase = await get_client()
+        await supabase.table('contest_settings').update({
             'status': 'verification_in_progress',
             'final_verification_started_at': 'NOW()'
         }).eq('is_active', True).execute()
+        invalidate_contest_cache()
         
         print("✅ Verifica finale avviata")
         return True
@@ -148,19 +279,169 @@ def start_final_verification():
         print(f"❌ Errore avvio verifica: {e}")
         return False
 
-def get_all_completed_referrals():
+async def get_all_completed_referrals():
     """Ottieni tutti i referral da verificare"""
     try:
-        result = supabase.table('referrals').select("*").eq('status', 'completed').execute()
+        supabase = await get_client()
+        result = await supabase.table('referrals').select("*").eq('status', 'completed').execute()
         return result.data
     except Exception as e:
         print(f"❌ Errore lettura referrals: {e}")
         return []
 
-def invalidate_referral(referrer_id, referred_id):
+async def count_referrals_to_verify():
+    """Numero di referral completati non ancora controllati dalla verifica finale (None se errore)"""
+    try:
+        supabase = await get_client()
+        result = await supabase.table('referrals').select("id", count='exact').eq('status', 'completed').is_('final_verification_status', 'null').limit(1).execute()
+        return result.count or 0
+    except Exception as e:
+        print(f"❌ Errore conteggio referrals da verificare: {e}")
+        return None
+
+async def iter_referred_to_verify(page_size=PAGE_SIZE):
+    """Utenti invitati con referral ancora da verificare, a pagine (keyset su referred_telegram_id)
+    
+    Ogni utente invitato viene restituito una sola volta. Solleva l'eccezione
+    se una pagina non può essere letta.
+    """
+    supabase = await get_client()
+    last_id = None
+    while True:
+        query = supabase.table('referrals').select("referred_telegram_id").eq('status', 'completed').is_('final_verification_status', 'null')
+        if last_id is not None:
+            query = query.gt('referred_telegram_id', last_id)
+        result = await query.order('referred_telegram_id').limit(page_size).execute()
+        
+        for row in result.data:
+            if row['referred_telegram_id'] != last_id:
+                last_id = row['referred_telegram_id']
+                yield last_id
+        
+        if len(result.data) < page_size:
+            return
+
+async def mark_referrals_verified(referred_ids):
+    """Segna come verificati (ancora nel canale) i referral di più utenti"""
+    if not referred_ids:
+        return True
+    try:
+        supabase = await get_client()
+        await supabase.table('referrals').update({
+            'final_verification_status': 'still_member'
+        }).in_('referred_telegram_id', list(referred_ids)).eq('status', 'completed').execute()
+        
+        return True
+    except Exception as e:
+        print(f"❌ Errore salvataggio referral verificati: {e}")
+        return False
+
+async def get_verification_counts():
+    """Conta referral validi e invalidati dalla verifica finale (anche tra più esecuzioni)"""
+    try:
+        supabase = await get_client()
+        valid = await supabase.table('referrals').select("id", count='exact').eq('final_verification_status', 'still_member').limit(1).execute()
+        invalid = await supabase.table('referrals').select("id", count='exact').eq('final_verification_status', 'left_channel').limit(1).execute()
+        return valid.count or 0, invalid.count or 0
+    except Exception as e:
+        print(f"❌ Errore conteggio verifiche: {e}")
+        return None, None
+
+async def set_referral_membership(referred_id, is_member, changed_at):
+    """Aggiorna il ledger: l'utente invitato è entrato/uscito dal canale alla data `changed_at`
+    
+    Gli update arrivati in ritardo (più vecchi dell'ultimo registrato) vengono ignorati.
+    """
+    try:
+        supabase = await get_client()
+        changed_at = changed_at.isoformat()
+        await supabase.table('referrals').update({
+            'membership_status': 'member' if is_member else 'left',
+            'membership_updated_at': changed_at
+        }, returning=ReturnMethod.minimal).eq('referred_telegram_id', referred_id).in_(
+            'status', ['pending', 'completed']
+        ).or_(f"membership_updated_at.is.null,membership_updated_at.lt.{changed_at}").execute()
+        return True
+    except Exception as e:
+        print(f"❌ Errore aggiornamento ledger iscrizioni: {e}")
+        return False
+
+async def mark_ledger_members_verified():
+    """Verifica finale: i referral 'member' nel ledger sono validi senza chiamate Bot API
+    
+    Restituisce il numero di referral segnati (None se errore).
+    """
+    try:
+        supabase = await get_client()
+        result = await supabase.table('referrals').update({
+            'final_verification_status': 'still_member'
+        }, count='exact', returning=ReturnMethod.minimal).eq('status', 'completed').is_(
+            'final_verification_status', 'null'
+        ).eq('membership_status', 'member').execute()
+        return result.count or 0
+    except Exception as e:
+        print(f"❌ Errore verifica da ledger: {e}")
+        return None
+
+async def get_referrals_to_reverify(limit, min_age_seconds):
+    """Utenti invitati da ricontrollare durante il contest, in ordine di priorità (None se errore)"""
+    try:
+        supabase = await get_client()
+        result = await supabase.rpc('referrals_to_reverify', {
+            'p_limit': limit,
+            'p_min_age_seconds': min_age_seconds
+        }).execute()
+        return [row['referred_telegram_id'] for row in result.data]
+    except Exception as e:
+        print(f"❌ Errore lettura referral da ricontrollare: {e}")
+        return None
+
+async def record_reverification(referred_ids, is_member, checked_at):
+    """Salva l'esito di un ricontrollo a campione (ledger e data di verifica)
+    
+    Come in set_referral_membership, i referral con un cambio registrato dopo
+    `checked_at` (es. uscita dal canale via chat_member) non vengono toccati.
+    """
+    if not referred_ids:
+        return True
+    try:
+        supabase = await get_client()
+        checked_at = checked_at.isoformat()
+        await supabase.table('referrals').update({
+            'membership_status': 'member' if is_member else 'left',
+            'membership_updated_at': checked_at,
+            'last_verified_at': checked_at
+        }, returning=ReturnMethod.minimal).in_('referred_telegram_id', list(referred_ids)).eq(
+            'status', 'completed'
+        ).or_(f"membership_updated_at.is.null,membership_updated_at.lt.{checked_at}").execute()
+        return True
+    except Exception as e:
+        print(f"❌ Errore salvataggio ricontrollo referral: {e}")
+        return False
+
+async def mark_recently_verified_members(max_age_seconds):
+    """Verifica finale: valida i referral 'member' controllati negli ultimi `max_age_seconds`
+    
+    Restituisce il numero di referral segnati (None se errore).
+    """
+    try:
+        supabase = await get_client()
+        since = (datetime.now(timezone.utc) - timedelta(seconds=max_age_seconds)).isoformat()
+        result = await supabase.table('referrals').update({
+            'final_verification_status': 'still_member'
+        }, count='exact', returning=ReturnMethod.minimal).eq('status', 'completed').is_(
+            'final_verification_status', 'null'
+        ).eq('membership_status', 'member').gte('last_verified_at', since).execute()
+        return result.count or 0
+    except Exception as e:
+        print(f"❌ Errore verifica da ricontrolli recenti: {e}")
+        return None
+
+async def invalidate_referral(referrer_id, referred_id):
     """Marca referral come non valido"""
     try:
-        supabase.table('referrals').update({
+        supabase = await get_client()
+        await supabase.table('referrals').update({
             'status': 'invalid',
             'final_verification_status': 'left_channel'
         }).eq('referrer_telegram_id', referrer_id).eq('referred_telegram_id', referred_id).execute()
@@ -170,43 +451,49 @@ def invalidate_referral(referrer_id, referred_id):
         print(f"❌ Errore invalidazione referral: {e}")
         return False
 
-def recalculate_final_scores():
-    """Ricalcola punteggi finali e posizioni"""
+async def invalidate_referrals(referred_ids):
+    """Marca come non validi i referral di più utenti con un'unica UPDATE"""
+    if not referred_ids:
+        return True
     try:
-        # Reset tutti i punteggi
-        supabase.table('users').update({'total_invites': 0}).neq('id', 0).execute()
-        
-        # Conta referral validi per ogni utente
-        valid_referrals = supabase.table('referrals').select("referrer_telegram_id").eq('status', 'completed').execute()
-        
-        user_scores = {}
-        for referral in valid_referrals.data:
-            referrer_id = referral['referrer_telegram_id']
-            user_scores[referrer_id] = user_scores.get(referrer_id, 0) + 1
-        
-        # Aggiorna punteggi nel database
-        for user_id, score in user_scores.items():
-            supabase.table('users').update({'total_invites': score}).eq('telegram_id', user_id).execute()
+        supabase = await get_client()
+        result = await supabase.table('referrals').update({
+            'status': 'invalid',
+            'final_verification_status': 'left_channel'
+        }).in_('referred_telegram_id', list(referred_ids)).eq('status', 'completed').execute()
         
-        # Calcola posizioni finali
-        users_ranked = supabase.table('users').select("telegram_id, total_invites").order('total_invites', desc=True).execute()
+        for referral in result.data:
+            leaderboard.add_invites(referral['referrer_telegram_id'], -1)
         
-        for position, user in enumerate(users_ranked.data, 1):
-            supabase.table('users').update({'final_position': position}).eq('telegram_id', user['telegram_id']).execute()
+        return True
+    except Exception as e:
+        print(f"❌ Errore invalidazione batch referral: {e}")
+        return False
+
+async def recalculate_final_scores():
+    """Ricalcola punteggi finali e posizioni"""
+    try:
+        supabase = await get_client()
+        # Conteggio referral validi, ranking e scrittura in un'unica chiamata
+        # (funzione SQL recalculate_final_scores, vedi supabase/migrations)
+        result = await supabase.rpc('recalculate_final_scores').execute()
+        updated_users = result.data or 0
         
-        print(f"✅ Punteggi finali ricalcolati per {len(users_ranked.data)} utenti")
+        print(f"✅ Punteggi finali ricalcolati per {updated_users} utenti")
         return True
     except Exception as e:
         print(f"❌ Errore ricalcolo punteggi: {e}")
         return False
 
-def complete_contest_verification():
+async def complete_contest_verification():
     """Completa il processo di verifica"""
     try:
-        supabase.table('contest_settings').update({
+        supabase = await get_client()
+        await supabase.table('contest_settings').update({
             'status': 'completed',
             'final_verification_completed_at': 'NOW()'
         }).eq('is_active', True).execute()
+        invalidate_contest_cache()
         
         print("✅ Contest completato")
         return True
@@ -214,30 +501,34 @@ def complete_contest_verification():
         print(f"❌ Errore completamento contest: {e}")
         return False
 
-def get_top_5_users():
+async def get_top_5_users():
     """Ottieni top 5 utenti per notifica admin"""
     try:
-        result = supabase.table('users').select("first_name, total_invites, final_position").order('total_invites', desc=True).limit(5).execute()
+        supabase = await get_client()
+        result = await supabase.table('users').select("first_name, total_invites, final_position").order('total_invites', desc=True).order('id').limit(5).execute()
         return result.data
     except Exception as e:
         print(f"❌ Errore lettura top 5: {e}")
         return []
 
-def get_total_participants():
+async def get_total_participants():
     """Ottieni numero totale partecipanti"""
     try:
-        result = supabase.table('users').select("id", count='exact').execute()
+        supabase = await get_client()
+        result = await supabase.table('users').select("id", count='exact').execute()
         return result.count
     except Exception as e:
         print(f"❌ Errore conteggio partecipanti: {e}")
         return 0
 
-def announce_results():
+async def announce_results():
     """Abilita visualizzazione risultati per gli utenti"""
     try:
-        supabase.table('contest_settings').update({
+        supabase = await get_client()
+        await supabase.table('contest_settings').update({
             'results_announced': True
         }).eq('is_active', True).execute()
+        invalidate_contest_cache()
         
         print("✅ Risultati annunciati - stats sbloccate per tutti")
         return True
@@ -245,12 +536,12 @@ def announce_results():
         print(f"❌ Errore annuncio risultati: {e}")
         return False
 
-def check_contest_end():
+async def check_contest_end():
     """Controlla se il contest deve terminare automaticamente"""
     try:
         from datetime import datetime
         
-        contest = get_current_contest()
+        contest = await get_current_contest()
         if not contest or contest['status'] != 'active':
             return False
         
@@ -266,30 +557,209 @@ def check_contest_end():
         print(f"❌ Errore controllo scadenza: {e}")
         return False
 
-def get_all_users():
+async def iter_users(columns="telegram_id, first_name", page_size=PAGE_SIZE):
+    """Itera tutti gli utenti a pagine (keyset su telegram_id), senza troncamenti
+    
+    `columns` deve includere telegram_id. Solleva l'eccezione se una pagina
+    non può essere letta.
+    """
+    supabase = await get_client()
+    last_id = None
+    while True:
+        query = supabase.table('users').select(columns)
+        if last_id is not None:
+            query = query.gt('telegram_id', last_id)
+        result = await query.order('telegram_id').limit(page_size).execute()
+        
+        for row in result.data:
+            yield row
+        
+        if len(result.data) < page_size:
+            return
+        last_id = result.data[-1]['telegram_id']
+
+async def get_all_users():
     """Ottieni tutti gli utenti registrati"""
     try:
-        result = supabase.table('users').select("telegram_id, first_name").execute()
-        return result.data
+        return [user async for user in iter_users()]
     except Exception as e:
         print(f"❌ Errore lettura utenti: {e}")
         return []
 
-def get_user_count():
+async def get_user_count():
     """Ottieni numero totale utenti"""
     try:
-        result = supabase.table('users').select("telegram_id", count='exact').execute()
+        supabase = await get_client()
+        result = await supabase.table('users').select("telegram_id", count='exact').execute()
         return result.count
     except Exception as e:
         print(f"❌ Errore conteggio utenti: {e}")
         return 0
 
-def check_contest_should_start():
+async def create_broadcast_job(kind, message_text, reply_markup, admin_id):
+    """Crea un job di broadcast con tutti gli utenti come destinatari pending"""
+    try:
+        supabase = await get_client()
+        result = await supabase.rpc('create_broadcast_job', {
+            'p_kind': kind,
+            'p_message_text': message_text,
+            'p_reply_markup': reply_markup,
+            'p_admin_id': admin_id
+        }).execute()
+        print(f"✅ Job broadcast creato: {result.data}")
+        return result.data
+    except Exception as e:
+        print(f"❌ Errore creazione job broadcast: {e}")
+        return None
+
+async def get_broadcast_job(job_id):
+    """Ottieni un job di broadcast"""
+    try:
+        supabase = await get_client()
+        result = await supabase.table('broadcast_jobs').select("*").eq('id', job_id).execute()
+        return result.data[0] if result.data else None
+    except Exception as e:
+        print(f"❌ Errore lettura job broadcast: {e}")
+        return None
+
+async def get_running_broadcast_jobs():
+    """Job di broadcast non completati (da riprendere dopo un riavvio)"""
+    try:
+        supabase = await get_client()
+        result = await supabase.table('broadcast_jobs').select("*").eq('status', 'running').order('id').execute()
+        return result.data
+    except Exception as e:
+        print(f"❌ Errore lettura job broadcast: {e}")
+        return []
+
+async def get_latest_broadcast_job():
+    """Ultimo job di broadcast creato"""
+    try:
+        supabase = await get_client()
+        result = await supabase.table('broadcast_jobs').select("*").order('id', desc=True).limit(1).execute()
+        return result.data[0] if result.data else None
+    except Exception as e:
+        print(f"❌ Errore lettura ultimo job broadcast: {e}")
+        return None
+
+async def get_pending_recipients(job_id, after_telegram_id=0, limit=PAGE_SIZE):
+    """Pagina di destinatari ancora da contattare (keyset su telegram_id, None se errore)"""
+    try:
+        supabase = await get_client()
+        result = await supabase.table('broadcast_recipients').select("telegram_id").eq('job_id', job_id).eq('status', 'pending').gt('telegram_id', after_telegram_id).order('telegram_id').limit(limit).execute()
+        return [row['telegram_id'] for row in result.data]
+    except Exception as e:
+        print(f"❌ Errore lettura destinatari broadcast: {e}")
+        return None
+
+async def iter_pending_recipients(job_id, page_size=PAGE_SIZE):
+    """Destinatari pending di un job, letti a pagine"""
+    after_telegram_id = 0
+    while True:
+        page = await get_pending_recipients(job_id, after_telegram_id, page_size)
+        if page is None:
+            raise RuntimeError(f"lettura destinatari del job {job_id} fallita")
+        
+        for telegram_id in page:
+            yield telegram_id
+        
+        if len(page) < page_size:
+            return
+        after_telegram_id = page[-1]
+
+async def set_recipients_status(job_id, telegram_ids, status):
+    """Aggiorna lo stato di consegna di più destinatari con un'unica UPDATE"""
+    try:
+        supabase = await get_client()
+        await supabase.table('broadcast_recipients').update({
+            'status': status,
+            'updated_at': 'NOW()'
+        }).eq('job_id', job_id).in_('telegram_id', list(telegram_ids)).execute()
+        
+        return True
+    except Exception as e:
+        print(f"❌ Errore aggiornamento destinatari broadcast: {e}")
+        return False
+
+async def get_broadcast_progress(job_id):
+    """Conteggio destinatari per stato: {'pending': n, 'sent': n, ...}; None se errore"""
+    try:
+        supabase = await get_client()
+        result = await supabase.rpc('broadcast_job_progress', {'p_job_id': job_id}).execute()
+        return {row['status']: row['recipients'] for row in result.data}
+    except Exception as e:
+        print(f"❌ Errore lettura avanzamento broadcast: {e}")
+        return None
+
+async def complete_broadcast_job(job_id):
+    """Segna un job di broadcast come completato"""
+    try:
+        supabase = await get_client()
+        await supabase.table('broadcast_jobs').update({
+            'status': 'completed',
+            'completed_at': 'NOW()'
+        }).eq('id', job_id).execute()
+        
+        return True
+    except Exception as e:
+        print(f"❌ Errore completamento job broadcast: {e}")
+        return False
+
+async def get_state(key):
+    """Valore non scaduto di una chiave di stato condiviso (None se assente)"""
+    try:
+        supabase = await get_client()
+        now = datetime.now(timezone.utc).isoformat()
+        result = await supabase.table('bot_state').select("value").eq('key', key).gt('expires_at', now).execute()
+        return result.data[0]['value'] if result.data else None
+    except Exception as e:
+        print(f"❌ Errore lettura stato {key}: {e}")
+        return None
+
+async def set_state(key, value, expires_at):
+    """Salva una chiave di stato condiviso con scadenza"""
+    try:
+        supabase = await get_client()
+        await supabase.table('bot_state').upsert({
+            'key': key,
+            'value': value,
+            'expires_at': expires_at.isoformat()
+        }).execute()
+        return True
+    except Exception as e:
+        print(f"❌ Errore salvataggio stato {key}: {e}")
+        return False
+
+async def pop_state(key):
+    """Elimina una chiave di stato condiviso restituendone il valore"""
+    try:
+        supabase = await get_client()
+        result = await supabase.table('bot_state').delete().eq('key', key).execute()
+        if not result.data:
+            return None
+        row = result.data[0]
+        expires_at = datetime.fromisoformat(row['expires_at'].replace('Z', '+00:00'))
+        return row['value'] if expires_at > datetime.now(timezone.utc) else None
+    except Exception as e:
+        print(f"❌ Errore eliminazione stato {key}: {e}")
+        return None
+
+async def purge_expired_state():
+    """Rimuove le chiavi di stato scadute"""
+    try:
+        supabase = await get_client()
+        result = await supabase.rpc('purge_expired_bot_state').execute()
+        return result.data
+    except Exception as e:
+        print(f"❌ Errore pulizia stato: {e}")
+        return 0
+
+async def check_contest_should_start():
     """Controlla se un contest schedulato deve iniziare"""
     try:
         from datetime import datetime, timezone
         
-        contest = get_current_contest()
+        contest = await get_current_contest()
         if not contest or contest['status'] != 'scheduled':
             return False
         
@@ -307,12 +777,12 @@ def check_contest_should_start():
         print(f"❌ Errore controllo inizio: {e}")
         return False
 
-def check_contest_end():
+async def check_contest_end():
     """Controlla se il contest deve terminare automaticamente"""
     try:
         from datetime import datetime, timezone
         
-        contest = get_current_contest()
+        contest = await get_current_contest()
         if not contest or contest['status'] != 'active':
             return False
         
@@ -330,12 +800,14 @@ def check_contest_end():
         print(f"❌ Errore controllo scadenza: {e}")
         return False
 
-def activate_scheduled_contest():
+async def activate_scheduled_contest():
     """Attiva un contest schedulato"""
     try:
-        supabase.table('contest_settings').update({
+        supabase = await get_client()
+        await supabase.table('contest_settings').update({
             'status': 'active'
         }).eq('status', 'scheduled').eq('is_active', True).execute()
+        invalidate_contest_cache()
         
         print("✅ Contest attivato automaticamente")
         return True
@@ -343,12 +815,12 @@ def activate_scheduled_contest():
         print(f"❌ Errore attivazione contest: {e}")
         return False
 
-def get_contest_with_status():
+async def get_contest_with_status():
     """Ottieni contest con controllo stato basato su date"""
     try:
         from datetime import datetime
         
-        contest = get_current_contest()
+        contest = await get_current_contest()
         if not contest:
             return None, None
         
@@ -370,12 +842,15 @@ def get_contest_with_status():
         return contest, contest['status'] if contest else None
 
 # Test temporaneo - aggiungi questa funzione
-def test_date_check():
-    contest = get_current_contest()
+async def test_date_check():
+    contest = await get_current_contest()
     if contest:
         from datetime import datetime
         start_date = datetime.fromisoformat(contest['start_date'].replace('Z', '+00:00'))
         now = datetime.now(start_date.tzinfo)
         print(f"DEBUG: Start date: {start_date}")
         print(f"DEBUG: Now: {now}")
-        print(f"DEBUG: Now >= Start: {now >= start_date}")
\ No newline at end of file
+        print(f"DEBUG: Now >= Start: {now >= start_date}")
+
+# Tempo di ogni funzione del modulo nell'istogramma bot_database_duration_seconds (/metrics)
+instrument_module(globals(), DATABASE_LATENCY, 'database', exclude=('get_client', 'close_client'))
@@ -0,0 +1,175 @@
+import asyncio
+import time
+from collections import OrderedDict
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from ratelimit import TokenBucket
+from metrics import FLOOD_WAITS
+
+# Limite globale Bot API (~30 messaggi/s) e margine lasciato agli utenti durante i job massivi
+GLOBAL_RATE = 30
+BULK_RATE = 25
+# Limiti per chat: 1 messaggio/s in privato, 20 al minuto nei gruppi/canali
+PRIVATE_CHAT_RATE = 1
+PRIVATE_CHAT_BURST = 3
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 3
+# Bucket per chat tenuti in memoria (i meno recenti vengono scartati: sarebbero pieni)
+MAX_CHAT_BUCKETS = 10000
+# Adattamento dopo un RetryAfter: rallenta subito, recupera gradualmente
+FLOOD_SLOWDOWN = 0.7
+MIN_GLOBAL_RATE = 5
+RECOVERY_INTERVAL = 60
+RECOVERY_STEP = 1
+# Nuovi tentativi dopo un RetryAfter prima di rilanciare l'errore al chiamante
+GOVERNOR_MAX_RETRIES = 2
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+# Metodi soggetti al limite globale (invio di messaggi) e a quello per chat
+GLOBAL_LIMITED_PREFIXES = ('send', 'copy', 'forward')
+CHAT_LIMITED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+class PriorityTokenBucket:
+    """Token bucket condiviso tra corsie: chi ha priorità alta passa sempre prima
+
+    Finché c'è una richiesta interattiva in attesa le richieste bulk non
+    prendono token. La velocità scende dopo un RetryAfter e risale di
+    RECOVERY_STEP ogni RECOVERY_INTERVAL secondi senza flood.
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=MIN_GLOBAL_RATE):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_flood = 0.0
+        self._priority_waiting = 0
+
+    def _refill(self, now):
+        if self.rate < self.max_rate and now - self._last_flood >= RECOVERY_INTERVAL:
+            self.rate = min(self.max_rate, self.rate + RECOVERY_STEP)
+            self._last_flood = now
+        elapsed = now - self._updated
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority=False):
+        if priority:
+            self._priority_waiting += 1
+        try:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._refill(now)
+                if self._tokens >= 1 and (priority or not self._priority_waiting):
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep(max((1 - self._tokens) / self.rate, 0.005))
+        finally:
+            if priority:
+                self._priority_waiting -= 1
+
+    def on_flood(self, seconds):
+        """RetryAfter di Telegram: pausa per tutti e velocità ridotta"""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+        self._updated = max(now, self._paused_until)
+        self._last_flood = self._updated
+        self.rate = max(self.min_rate, self.rate * FLOOD_SLOWDOWN)
+
+class RateGovernor:
+    """Regolatore unico delle chiamate Bot API di tutto il processo
+
+    Applica il limite globale agli invii di messaggi e quelli per chat a
+    invii e modifiche (le altre chiamate, es. answerCallbackQuery o
+    getChatMember, non passano dal bucket globale), dando precedenza alla
+    corsia interattiva (risposte agli utenti) su quella bulk (broadcast,
+    verifiche, ricontrolli). Dopo un RetryAfter tutte le chiamate, di
+    qualsiasi metodo, attendono il tempo indicato da Telegram. Ogni corsia
+    è un rate limiter di PTB da collegare al proprio Bot.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, bulk_rate=BULK_RATE):
+        self._global = PriorityTokenBucket(global_rate)
+        self._bulk = TokenBucket(bulk_rate)
+        self._chats = OrderedDict()   # chat_id -> TokenBucket
+        self._paused_until = 0.0      # fine del flood ban (vale per ogni metodo)
+
+    def lane(self, priority):
+        return GovernorLane(self, priority)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            if is_private:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+            else:
+                bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > MAX_CHAT_BUCKETS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _wait_flood_ban(self):
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def _on_flood(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._global.on_flood(seconds)
+
+    async def _acquire(self, endpoint, data, priority):
+        await self._wait_flood_ban()
+        chat_id = data.get('chat_id') if data else None
+        if chat_id is not None and endpoint.startswith(CHAT_LIMITED_PREFIXES):
+            await self._chat_bucket(chat_id).acquire()
+        if priority == BULK:
+            await self._bulk.acquire()
+        if endpoint.startswith(GLOBAL_LIMITED_PREFIXES):
+            await self._global.acquire(priority == INTERACTIVE)
+        # Un RetryAfter arrivato mentre si attendeva un token
+        await self._wait_flood_ban()
+
+    async def process(self, callback, args, kwargs, endpoint, data, priority):
+        for attempt in range(GOVERNOR_MAX_RETRIES + 1):
+            await self._acquire(endpoint, data, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                FLOOD_WAITS.inc(operation=f"governor_{priority}")
+                self._on_flood(e.retry_after)
+                if attempt == GOVERNOR_MAX_RETRIES:
+                    raise
+                print(f"⏳ Flood control su {endpoint}: pausa di {e.retry_after}s")
+
+class GovernorLane(BaseRateLimiter):
+    """Corsia del RateGovernor, da passare come rate_limiter a un Bot"""
+
+    def __init__(self, governor, priority):
+        self.governor = governor
+        self.priority = priority
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        return await self.governor.process(callback, args, kwargs, endpoint, data, self.priority)
+
+# Regolatore condiviso dal Bot interattivo e da quello dei job massivi
+governor = RateGovernor()
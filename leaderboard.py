@@ -0,0 +1,135 @@
+import asyncio
+import bisect
+from referral_codes import referral_codes, ReferralCodeIndex
+
+# Ogni quanto (secondi) riallineare la classifica con il database
+LEADERBOARD_RESYNC_INTERVAL = 600
+
+class Leaderboard:
+    """Classifica in memoria del contest attivo
+
+    Gli utenti sono raggruppati per numero di inviti; un Fenwick tree sui
+    conteggi dà la posizione di un utente in O(log n) e la top-N si ottiene
+    scorrendo i gruppi dal più alto. A parità di inviti la posizione è la
+    stessa (1, 2, 2, 4...).
+    """
+
+    def __init__(self, capacity=64):
+        self._invites = {}      # telegram_id -> inviti
+        self._names = {}        # telegram_id -> first_name
+        self._buckets = {}      # inviti -> {telegram_id: None} (ordine di arrivo)
+        self._counts = []       # numeri di inviti presenti, ordinati
+        self._capacity = capacity
+        self._tree = [0] * (capacity + 1)
+
+    def __len__(self):
+        return len(self._invites)
+
+    def __contains__(self, telegram_id):
+        return telegram_id in self._invites
+
+    # Fenwick tree: numero di utenti per ogni valore di inviti
+    def _tree_add(self, invites, delta):
+        i = invites + 1
+        while i <= self._capacity:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _count_at_most(self, invites):
+        i = min(invites + 1, self._capacity)
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _grow(self, invites):
+        self._capacity = max(self._capacity * 2, invites + 1)
+        self._tree = [0] * (self._capacity + 1)
+        for count, bucket in self._buckets.items():
+            self._tree_add(count, len(bucket))
+
+    def _insert(self, telegram_id, invites):
+        if invites >= self._capacity:
+            self._grow(invites)
+        bucket = self._buckets.setdefault(invites, {})
+        if not bucket:
+            bisect.insort(self._counts, invites)
+        bucket[telegram_id] = None
+        self._invites[telegram_id] = invites
+        self._tree_add(invites, 1)
+
+    def _remove(self, telegram_id):
+        invites = self._invites.pop(telegram_id)
+        bucket = self._buckets[invites]
+        del bucket[telegram_id]
+        if not bucket:
+            del self._buckets[invites]
+            del self._counts[bisect.bisect_left(self._counts, invites)]
+        self._tree_add(invites, -1)
+        return invites
+
+    def set_user(self, telegram_id, first_name, invites=0):
+        """Aggiunge o sovrascrive un utente"""
+        if telegram_id in self._invites:
+            self._remove(telegram_id)
+        self._names[telegram_id] = first_name
+        self._insert(telegram_id, max(invites, 0))
+
+    def add_invites(self, telegram_id, delta):
+        """Aggiorna incrementalmente gli inviti (delta negativo per le invalidazioni)"""
+        if telegram_id not in self._invites:
+            return
+        invites = self._remove(telegram_id)
+        self._insert(telegram_id, max(invites + delta, 0))
+
+    def position(self, telegram_id):
+        """Posizione attuale (1 = primo), None se l'utente non è in classifica"""
+        invites = self._invites.get(telegram_id)
+        if invites is None:
+            return None
+        return len(self._invites) - self._count_at_most(invites) + 1
+
+    def top(self, n=5):
+        """Primi n utenti: lista di (posizione, first_name, inviti)"""
+        result = []
+        position = 1
+        for invites in reversed(self._counts):
+            bucket = self._buckets[invites]
+            for telegram_id in bucket:
+                if len(result) >= n:
+                    return result
+                result.append((position, self._names.get(telegram_id), invites))
+            position += len(bucket)
+        return result
+
+    def replace(self, other):
+        """Sostituisce il contenuto con quello di un'altra classifica (ricarica atomica)"""
+        self.__dict__.update(other.__dict__)
+
+# Classifica condivisa dal processo
+leaderboard = Leaderboard()
+
+async def load_leaderboard():
+    """Ricarica la classifica e l'indice dei codici referral (utenti letti a pagine)"""
+    from database import iter_users
+    fresh = Leaderboard()
+    fresh_codes = ReferralCodeIndex()
+    try:
+        async for user in iter_users("telegram_id, first_name, total_invites, referral_code"):
+            fresh.set_user(user['telegram_id'], user['first_name'], user['total_invites'] or 0)
+            fresh_codes.add(user['referral_code'])
+    except Exception as e:
+        print(f"❌ Errore caricamento classifica: {e}")
+        return False
+
+    leaderboard.replace(fresh)
+    referral_codes.replace(fresh_codes)
+    print(f"🏅 Classifica caricata: {len(leaderboard)} utenti, {len(referral_codes)} codici referral")
+    return True
+
+async def leaderboard_resync_loop():
+    """Riallinea periodicamente la classifica (aggiornamenti da altri processi)"""
+    while True:
+        await load_leaderboard()
+        await asyncio.sleep(LEADERBOARD_RESYNC_INTERVAL)
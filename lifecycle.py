@@ -0,0 +1,84 @@
+import asyncio
+from datetime import datetime, timezone
+from database import (get_current_contest, check_contest_should_start, activate_scheduled_contest,
+                     check_contest_end, start_final_verification, on_contest_change)
+from verification import run_final_verification
+
+# Riletture di sicurezza per modifiche al contest fatte fuori dal bot (es. dashboard Supabase)
+LIFECYCLE_MAX_SLEEP = 900
+# Attesa prima di ritentare una transizione fallita
+LIFECYCLE_RETRY_DELAY = 60
+
+# Segnalato a ogni cambio del contest: lo scheduler ricalcola la prossima transizione
+_rearm = asyncio.Event()
+on_contest_change(_rearm.set)
+
+def parse_contest_date(value):
+    """Date del contest salvate in UTC (anche senza timezone)"""
+    return datetime.fromisoformat(value.replace('Z', '').replace('+00:00', '')).replace(tzinfo=timezone.utc)
+
+def next_transition(contest):
+    """Prossima transizione del contest: ('start' | 'end', data UTC) oppure None"""
+    if not contest:
+        return None
+    if contest['status'] == 'scheduled' and contest.get('start_date'):
+        return 'start', parse_contest_date(contest['start_date'])
+    if contest['status'] == 'active' and contest.get('end_date'):
+        return 'end', parse_contest_date(contest['end_date'])
+    return None
+
+async def run_transition(bot, admin_id, action):
+    """Esegue la transizione scaduta; False se va ritentata"""
+    if action == 'start':
+        if not await check_contest_should_start():
+            return False
+        print("🚀 Attivando contest automaticamente...")
+        if not await activate_scheduled_contest():
+            print("❌ Errore attivazione contest")
+            return False
+        await bot.send_message(admin_id, "🚀 Contest avviato automaticamente!")
+        print("✅ Contest attivato")
+        return True
+
+    if not await check_contest_end():
+        return False
+    print("🕐 Contest scaduto - avvio verifica automatica")
+    if not await start_final_verification():
+        print("❌ Errore avvio verifica finale")
+        return False
+    print("🔍 Avvio verifica finale automatica...")
+    await run_final_verification(bot, admin_id)
+    return True
+
+async def contest_lifecycle_loop(bot, admin_id):
+    """Avvia e chiude il contest esattamente a start_date / end_date
+
+    Dorme fino alla prossima transizione e si riarma quando il contest
+    cambia (invalidate_contest_cache), senza polling periodico.
+    """
+    while True:
+        try:
+            # Azzerato prima di leggere il contest: un cambio successivo non va perso
+            _rearm.clear()
+            contest = await get_current_contest()
+            transition = next_transition(contest)
+
+            timeout = LIFECYCLE_MAX_SLEEP
+            if transition:
+                action, due = transition
+                delay = (due - datetime.now(timezone.utc)).total_seconds()
+                if delay <= 0:
+                    if not await run_transition(bot, admin_id, action):
+                        await asyncio.sleep(LIFECYCLE_RETRY_DELAY)
+                    continue
+                # Piccolo margine: check_contest_end richiede now > end_date
+                timeout = min(delay + 1, LIFECYCLE_MAX_SLEEP)
+                print(f"📅 Prossima transizione contest: {action} alle {due:%Y-%m-%d %H:%M:%S} UTC")
+
+            try:
+                await asyncio.wait_for(_rearm.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        except Exception as e:
+            print(f"❌ Errore scheduler contest: {e}")
+            await asyncio.sleep(LIFECYCLE_RETRY_DELAY)
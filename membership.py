@@ -0,0 +1,63 @@
+import asyncio
+from state_store import MemoryStateStore
+
+# Un utente iscritto raramente esce entro pochi minuti; chi non è iscritto
+# può iscriversi da un momento all'altro, quindi l'esito negativo dura poco
+MEMBER_TTL = 600
+NON_MEMBER_TTL = 3
+
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+class MembershipService:
+    """Lookup dell'iscrizione al canale con cache e coalescing delle richieste
+
+    Le richieste concorrenti per la stessa coppia (canale, utente) condividono
+    un'unica chiamata get_chat_member. Gli errori della Bot API (RetryAfter,
+    BadRequest, rete...) vengono propagati a tutti i chiamanti e non sono
+    messi in cache.
+    """
+
+    def __init__(self, member_ttl=MEMBER_TTL, non_member_ttl=NON_MEMBER_TTL):
+        self._members = MemoryStateStore(member_ttl)
+        self._non_members = MemoryStateStore(non_member_ttl)
+        self._in_flight = {}
+
+    async def is_member(self, bot, channel_id, user_id, use_cache=True):
+        """True se l'utente è iscritto al canale
+
+        Con use_cache=False l'esito viene sempre riletto da Telegram (es.
+        verifica finale), ma si accoda comunque a una lettura già in corso.
+        """
+        key = (channel_id, user_id)
+        if use_cache:
+            if await self._members.get(key):
+                return True
+            if await self._non_members.get(key):
+                return False
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(bot, channel_id, user_id))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        return await asyncio.shield(task)
+
+    async def _fetch(self, bot, channel_id, user_id):
+        member = await bot.get_chat_member(channel_id, user_id)
+        is_member = member.status in MEMBER_STATUSES
+        await self.record(channel_id, user_id, is_member)
+        return is_member
+
+    async def record(self, channel_id, user_id, is_member):
+        """Aggiorna la cache con un esito noto (es. appena verificato)"""
+        key = (channel_id, user_id)
+        if is_member:
+            await self._non_members.pop(key)
+            await self._members.set(key, True)
+        else:
+            await self._members.pop(key)
+            await self._non_members.set(key, True)
+
+# Servizio condiviso da handler e verifica finale
+membership = MembershipService()
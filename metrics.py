@@ -0,0 +1,139 @@
+import functools
+import inspect
+import time
+from telegram.request import HTTPXRequest
+
+# Limiti (secondi) dei bucket degli istogrammi di latenza
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Counter:
+    """Contatore monotono per combinazione di etichette"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    """Istogramma cumulativo (formato Prometheus) per combinazione di etichette"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}   # etichette -> [conteggi per bucket, somma, totale]
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+HANDLER_LATENCY = Histogram('bot_handler_duration_seconds', "Durata degli handler degli update", ('handler',))
+DATABASE_LATENCY = Histogram('bot_database_duration_seconds', "Durata delle funzioni di database.py", ('function',))
+TELEGRAM_LATENCY = Histogram('bot_telegram_api_duration_seconds', "Durata delle chiamate Bot API", ('method',))
+SUPABASE_RESPONSES = Counter('bot_supabase_responses_total', "Risposte HTTP di Supabase per codice", ('status',))
+TELEGRAM_RESPONSES = Counter('bot_telegram_api_responses_total', "Risposte Bot API per metodo e codice", ('method', 'status'))
+ERRORS = Counter('bot_errors_total', "Eccezioni non gestite per componente", ('source', 'name'))
+FLOOD_WAITS = Counter('bot_telegram_retry_after_total', "RetryAfter (429) gestiti per operazione", ('operation',))
+RETRIES = Counter('bot_retries_total', "Nuovi tentativi dopo errori transitori per operazione", ('operation',))
+
+METRICS = (HANDLER_LATENCY, DATABASE_LATENCY, TELEGRAM_LATENCY, SUPABASE_RESPONSES,
+           TELEGRAM_RESPONSES, ERRORS, FLOOD_WAITS, RETRIES)
+
+def render_metrics():
+    """Tutte le metriche nel formato testuale di Prometheus"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def timed(histogram, source):
+    """Decoratore per coroutine: durata in `histogram`, eccezioni in ERRORS"""
+    def decorator(func):
+        name = func.__name__
+        label = histogram.labelnames[0]
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                ERRORS.inc(source=source, name=name)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, **{label: name})
+        return wrapper
+    return decorator
+
+def timed_handler(handler):
+    return timed(HANDLER_LATENCY, 'handler')(handler)
+
+def instrument_module(namespace, histogram, source, exclude=()):
+    """Applica `timed` a tutte le coroutine pubbliche definite nel modulo"""
+    module = namespace['__name__']
+    for name, value in list(namespace.items()):
+        if (not name.startswith('_') and name not in exclude
+                and inspect.iscoroutinefunction(value) and value.__module__ == module):
+            namespace[name] = timed(histogram, source)(value)
+
+async def count_supabase_response(response):
+    """Event hook httpx del client Supabase"""
+    SUPABASE_RESPONSES.inc(status=response.status_code)
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest che misura ogni chiamata Bot API per metodo"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            ERRORS.inc(source='telegram', name=api_method)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - start, method=api_method)
+        TELEGRAM_RESPONSES.inc(method=api_method, status=status)
+        return status, payload
@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+class TokenBucket:
+    """Token bucket asincrono: `rate` richieste al secondo, burst fino a `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens=1):
+        """Attende finché non sono disponibili `tokens` token (ordine FIFO)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+
+                # Pausa globale dopo un RetryAfter di Telegram
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Blocca il bucket per `seconds` secondi (es. RetryAfter) e svuota il burst"""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+        self._updated = max(now, self._paused_until)
@@ -0,0 +1,52 @@
+import re
+from state_store import MemoryStateStore
+
+# Formato dei codici generati da create_user (REF_<telegram_id>)
+REFERRAL_CODE_PATTERN = re.compile(r'REF_\d{1,20}')
+# Codici risultati inesistenti: scartati senza interrogare il database per questo periodo
+UNKNOWN_CODE_TTL = 900
+
+class ReferralCodeIndex:
+    """Filtro in memoria dei codici referral esistenti
+
+    Caricato all'avvio insieme alla classifica (stessa scansione degli
+    utenti) e aggiornato a ogni registrazione. I codici malformati e quelli
+    già risultati inesistenti (cache negativa) vengono rifiutati senza
+    round-trip; un codice valido ma non ancora indicizzato (es. utente
+    creato da un'altra replica) viene lasciato verificare al database, che
+    risolve il referrer nella RPC register_via_referral.
+    """
+
+    def __init__(self, unknown_ttl=UNKNOWN_CODE_TTL):
+        self._codes = set()
+        self._unknown = MemoryStateStore(unknown_ttl)
+        # True dopo il primo caricamento completo (classifica compresa)
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._codes)
+
+    def add(self, referral_code):
+        if referral_code:
+            self._codes.add(referral_code)
+
+    async def may_exist(self, referral_code):
+        """False se il codice è sicuramente non valido (nessuna query necessaria)"""
+        if referral_code in self._codes:
+            return True
+        if not REFERRAL_CODE_PATTERN.fullmatch(referral_code):
+            return False
+        return not await self._unknown.get(referral_code)
+
+    async def mark_unknown(self, referral_code):
+        """Il database ha confermato che il codice non esiste"""
+        if REFERRAL_CODE_PATTERN.fullmatch(referral_code):
+            await self._unknown.set(referral_code, True)
+
+    def replace(self, other):
+        """Sostituisce i codici con quelli ricaricati (la cache negativa resta)"""
+        self._codes = other._codes
+        self.loaded = True
+
+# Indice condiviso dal processo
+referral_codes = ReferralCodeIndex()
@@ -0,0 +1,68 @@
+import asyncio
+from datetime import datetime, timezone
+from database import get_current_contest, get_referrals_to_reverify, record_reverification
+from verification import verify_memberships, RECENT_VERIFICATION_MAX_AGE
+from batching import OutcomeBuffer
+
+# Budget Bot API del ricontrollo a campione (richieste/s): ~170k controlli al giorno,
+# lasciando quasi tutto il limite globale agli utenti
+REVERIFY_RATE = 2
+REVERIFY_CONCURRENCY = 2
+# Referral letti per ogni giro e intervallo minimo tra due controlli dello stesso referral
+REVERIFY_BATCH_SIZE = 200
+# Metà della validità concessa dalla verifica finale: ogni controllo viene rinnovato
+# prima di scadere, così a fine contest è riutilizzabile
+REVERIFY_MIN_AGE = RECENT_VERIFICATION_MAX_AGE // 2
+# Attesa quando il contest non è attivo o non c'è nulla da ricontrollare
+REVERIFY_IDLE_SLEEP = 600
+# Esiti scritti al massimo ogni REVERIFY_FLUSH_INTERVAL secondi
+REVERIFY_FLUSH_INTERVAL = 60
+
+async def write_reverification_results(is_member, checks):
+    """Writer dell'OutcomeBuffer: coppie (referral, data del controllo) per iscritto/uscito
+
+    Il blocco viene datato al controllo più vecchio: un cambio arrivato dopo
+    un qualsiasi controllo del blocco non viene mai sovrascritto.
+    """
+    referred_ids = [referred_id for referred_id, _ in checks]
+    checked_at = min(checked_at for _, checked_at in checks)
+    return await record_reverification(referred_ids, is_member, checked_at)
+
+async def reverify_batch(bot, channel_id):
+    """Ricontrolla un blocco di referral; restituisce quanti ne ha controllati"""
+    referred_ids = await get_referrals_to_reverify(REVERIFY_BATCH_SIZE, REVERIFY_MIN_AGE)
+    if not referred_ids:
+        return 0
+
+    async def referred():
+        for referred_id in referred_ids:
+            yield referred_id
+
+    results = OutcomeBuffer(write_reverification_results, REVERIFY_BATCH_SIZE, REVERIFY_FLUSH_INTERVAL)
+
+    async def on_result(user_id, is_member):
+        # Nessuna invalidazione durante il contest: un'uscita resta 'left' nel
+        # ledger e verrà riconfermata dalla verifica finale
+        if is_member is not None:
+            await results.add((user_id, datetime.now(timezone.utc)), is_member)
+
+    counts = await verify_memberships(bot, channel_id, referred(), on_result=on_result,
+                                      rate=REVERIFY_RATE, concurrency=REVERIFY_CONCURRENCY)
+    await results.flush()
+    print(f"🔁 Ricontrollo a campione: {counts['member']} iscritti, {counts['left']} usciti, "
+          f"{counts['unverified']} non verificabili")
+    return len(referred_ids)
+
+async def reverification_loop(bot):
+    """Ricontrolla in background l'iscrizione dei referral per tutta la durata del contest"""
+    while True:
+        try:
+            contest = await get_current_contest()
+            checked = 0
+            if contest and contest['status'] == 'active':
+                checked = await reverify_batch(bot, contest['channel_id'])
+            if not checked:
+                await asyncio.sleep(REVERIFY_IDLE_SLEEP)
+        except Exception as e:
+            print(f"❌ Errore ricontrollo a campione: {e}")
+            await asyncio.sleep(REVERIFY_IDLE_SLEEP)
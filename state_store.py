@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from config import STATE_BACKEND
+
+class MemoryStateStore:
+    """Store chiave → valore del singolo processo, con scadenza e limite LRU"""
+
+    def __init__(self, ttl, max_items=50000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items = OrderedDict()
+
+    async def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if time.monotonic() >= expires_at:
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    async def set(self, key, value):
+        self._items[key] = (value, time.monotonic() + self.ttl)
+        self._items.move_to_end(key)
+        # Evita crescita illimitata: scarta le chiavi usate meno di recente
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    async def pop(self, key):
+        item = self._items.pop(key, None)
+        if item is None or time.monotonic() >= item[1]:
+            return None
+        return item[0]
+
+class SupabaseStateStore:
+    """Store condiviso da più processi del bot (tabella bot_state)"""
+
+    # Ogni quante scritture eliminare le righe scadute
+    PURGE_EVERY = 1000
+
+    def __init__(self, namespace, ttl):
+        self.namespace = namespace
+        self.ttl = ttl
+        self._writes = 0
+
+    def _key(self, key):
+        return f"{self.namespace}:{key}"
+
+    async def get(self, key):
+        from database import get_state
+        return await get_state(self._key(key))
+
+    async def set(self, key, value):
+        from database import set_state, purge_expired_state
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        await set_state(self._key(key), value, expires_at)
+
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            await purge_expired_state()
+
+    async def pop(self, key):
+        from database import pop_state
+        return await pop_state(self._key(key))
+
+def create_state_store(namespace, ttl):
+    """Store per `namespace` secondo STATE_BACKEND ('memory' o 'supabase')"""
+    if STATE_BACKEND == 'supabase':
+        return SupabaseStateStore(namespace, ttl)
+    return MemoryStateStore(ttl)
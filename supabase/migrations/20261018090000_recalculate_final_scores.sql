@@ -0,0 +1,35 @@
+-- Ricalcolo punteggi finali e posizioni in un'unica istruzione set-based.
+-- Sostituisce i due loop di UPDATE per utente di recalculate_final_scores().
+--
+-- Parità di inviti: vince chi si è registrato prima (users.id crescente),
+-- quindi le posizioni sono sempre uniche e deterministiche.
+create or replace function recalculate_final_scores()
+returns integer
+language sql
+as $$
+    with scores as (
+        select referrer_telegram_id as telegram_id, count(*)::int as valid_invites
+        from referrals
+        where status = 'completed'
+        group by referrer_telegram_id
+    ),
+    ranked as (
+        select
+            u.telegram_id,
+            coalesce(s.valid_invites, 0) as total_invites,
+            row_number() over (
+                order by coalesce(s.valid_invites, 0) desc, u.id asc
+            )::int as final_position
+        from users u
+        left join scores s on s.telegram_id = u.telegram_id
+    ),
+    updated as (
+        update users u
+        set total_invites = r.total_invites,
+            final_position = r.final_position
+        from ranked r
+        where u.telegram_id = r.telegram_id
+        returning 1
+    )
+    select count(*)::int from updated;
+$$;
@@ -0,0 +1,60 @@
+-- Broadcast persistenti: un job per invio e uno stato per ogni destinatario,
+-- così un broadcast interrotto riprende senza rimandare i messaggi già inviati.
+create table if not exists broadcast_jobs (
+    id bigserial primary key,
+    kind text not null,                        -- 'message' | 'contest_results'
+    message_text text not null,
+    reply_markup jsonb,                        -- InlineKeyboardMarkup.to_dict()
+    admin_id bigint,
+    status text not null default 'running',    -- 'running' | 'completed'
+    created_at timestamptz not null default now(),
+    completed_at timestamptz
+);
+
+create table if not exists broadcast_recipients (
+    job_id bigint not null references broadcast_jobs(id) on delete cascade,
+    telegram_id bigint not null,
+    status text not null default 'pending',    -- 'pending' | 'sent' | 'failed' | 'blocked'
+    updated_at timestamptz not null default now(),
+    primary key (job_id, telegram_id)
+);
+
+create index if not exists broadcast_recipients_pending_idx
+    on broadcast_recipients (job_id, telegram_id)
+    where status = 'pending';
+
+-- Crea il job e la lista destinatari (tutti gli utenti) in un'unica chiamata
+create or replace function create_broadcast_job(
+    p_kind text,
+    p_message_text text,
+    p_reply_markup jsonb,
+    p_admin_id bigint
+)
+returns bigint
+language plpgsql
+as $$
+declare
+    v_job_id bigint;
+begin
+    insert into broadcast_jobs (kind, message_text, reply_markup, admin_id)
+    values (p_kind, p_message_text, p_reply_markup, p_admin_id)
+    returning id into v_job_id;
+
+    insert into broadcast_recipients (job_id, telegram_id)
+    select v_job_id, telegram_id from users;
+
+    return v_job_id;
+end;
+$$;
+
+-- Avanzamento di un job: numero di destinatari per stato
+create or replace function broadcast_job_progress(p_job_id bigint)
+returns table (status text, recipients bigint)
+language sql
+stable
+as $$
+    select status, count(*)
+    from broadcast_recipients
+    where job_id = p_job_id
+    group by status;
+$$;
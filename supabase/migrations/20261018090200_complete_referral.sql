@@ -0,0 +1,42 @@
+-- Completamento referral atomico: stato del referral, referred_by e contatore
+-- del referrer in un'unica transazione. L'incremento è total_invites + 1 lato
+-- server, quindi due completamenti concorrenti non perdono aggiornamenti.
+--
+-- Idempotente: se il referral è già completato restituisce true senza
+-- incrementare di nuovo; false se non esiste un referral per la coppia.
+create or replace function complete_referral(p_referrer_id bigint, p_referred_id bigint)
+returns boolean
+language plpgsql
+as $$
+declare
+    v_completed integer;
+begin
+    update referrals
+    set status = 'completed',
+        completed_at = now()
+    where referrer_telegram_id = p_referrer_id
+      and referred_telegram_id = p_referred_id
+      and status = 'pending';
+
+    get diagnostics v_completed = row_count;
+
+    if v_completed = 0 then
+        return exists (
+            select 1 from referrals
+            where referrer_telegram_id = p_referrer_id
+              and referred_telegram_id = p_referred_id
+              and status = 'completed'
+        );
+    end if;
+
+    update users
+    set referred_by = p_referrer_id
+    where telegram_id = p_referred_id;
+
+    update users
+    set total_invites = total_invites + v_completed
+    where telegram_id = p_referrer_id;
+
+    return true;
+end;
+$$;
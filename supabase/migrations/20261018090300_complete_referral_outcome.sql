@@ -0,0 +1,46 @@
+-- complete_referral restituisce l'esito invece di un booleano, così il bot
+-- aggiorna la classifica in memoria solo quando il contatore è cambiato:
+--   'completed'          referral completato ora (total_invites + 1)
+--   'already_completed'  chiamata ripetuta, nessun incremento
+--   'not_found'          nessun referral per la coppia
+drop function if exists complete_referral(bigint, bigint);
+
+create function complete_referral(p_referrer_id bigint, p_referred_id bigint)
+returns text
+language plpgsql
+as $$
+declare
+    v_completed integer;
+begin
+    update referrals
+    set status = 'completed',
+        completed_at = now()
+    where referrer_telegram_id = p_referrer_id
+      and referred_telegram_id = p_referred_id
+      and status = 'pending';
+
+    get diagnostics v_completed = row_count;
+
+    if v_completed = 0 then
+        if exists (
+            select 1 from referrals
+            where referrer_telegram_id = p_referrer_id
+              and referred_telegram_id = p_referred_id
+              and status = 'completed'
+        ) then
+            return 'already_completed';
+        end if;
+        return 'not_found';
+    end if;
+
+    update users
+    set referred_by = p_referrer_id
+    where telegram_id = p_referred_id;
+
+    update users
+    set total_invites = total_invites + v_completed
+    where telegram_id = p_referrer_id;
+
+    return 'completed';
+end;
+$$;
@@ -0,0 +1,20 @@
+-- Stato condiviso tra più processi del bot (es. messaggi di condivisione da
+-- cancellare). Ogni chiave ha una scadenza; le righe scadute vengono ignorate
+-- in lettura e rimosse periodicamente da purge_expired_bot_state().
+create table if not exists bot_state (
+    key text primary key,
+    value jsonb,
+    expires_at timestamptz not null
+);
+
+create index if not exists bot_state_expires_at_idx on bot_state (expires_at);
+
+create or replace function purge_expired_bot_state()
+returns integer
+language sql
+as $$
+    with deleted as (
+        delete from bot_state where expires_at < now() returning 1
+    )
+    select count(*)::int from deleted;
+$$;
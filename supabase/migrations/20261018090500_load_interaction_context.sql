@@ -0,0 +1,24 @@
+-- Dati di un utente necessari agli handler dei pulsanti in un'unica chiamata:
+-- riga users (null se non registrato) e referral pending (null se assente).
+-- Il contest arriva dalla cache del bot, quindi ogni tap costa un round-trip.
+create or replace function load_interaction_context(p_telegram_id bigint)
+returns json
+language sql
+stable
+as $$
+    select json_build_object(
+        'user', (
+            select row_to_json(u)
+            from users u
+            where u.telegram_id = p_telegram_id
+            limit 1
+        ),
+        'pending_referral', (
+            select row_to_json(r)
+            from referrals r
+            where r.referred_telegram_id = p_telegram_id
+              and r.status = 'pending'
+            limit 1
+        )
+    );
+$$;
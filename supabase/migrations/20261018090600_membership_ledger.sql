@@ -0,0 +1,53 @@
+-- Ledger dell'iscrizione al canale degli utenti invitati, aggiornato in tempo
+-- reale dagli update chat_member. La verifica finale ricontrolla con la Bot API
+-- solo i referral il cui stato non è noto ('left' o mai registrato).
+alter table referrals
+    add column if not exists membership_status text,
+    add column if not exists membership_updated_at timestamptz;
+
+create index if not exists referrals_referred_telegram_id_idx
+    on referrals (referred_telegram_id);
+
+-- Il referral viene completato subito dopo aver verificato l'iscrizione:
+-- da quel momento l'utente risulta 'member' nel ledger.
+create or replace function complete_referral(p_referrer_id bigint, p_referred_id bigint)
+returns text
+language plpgsql
+as $$
+declare
+    v_completed integer;
+begin
+    update referrals
+    set status = 'completed',
+        completed_at = now(),
+        membership_status = 'member',
+        membership_updated_at = now()
+    where referrer_telegram_id = p_referrer_id
+      and referred_telegram_id = p_referred_id
+      and status = 'pending';
+
+    get diagnostics v_completed = row_count;
+
+    if v_completed = 0 then
+        if exists (
+            select 1 from referrals
+            where referrer_telegram_id = p_referrer_id
+              and referred_telegram_id = p_referred_id
+              and status = 'completed'
+        ) then
+            return 'already_completed';
+        end if;
+        return 'not_found';
+    end if;
+
+    update users
+    set referred_by = p_referrer_id
+    where telegram_id = p_referred_id;
+
+    update users
+    set total_invites = total_invites + v_completed
+    where telegram_id = p_referrer_id;
+
+    return 'completed';
+end;
+$$;
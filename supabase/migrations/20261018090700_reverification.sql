@@ -0,0 +1,71 @@
+-- Ri-verifica a campione durante il contest: data dell'ultimo controllo
+-- dell'iscrizione al canale per ogni referral. La verifica finale salta i
+-- referral controllati di recente e ancora 'member'.
+alter table referrals
+    add column if not exists last_verified_at timestamptz;
+
+create index if not exists referrals_status_last_verified_at_idx
+    on referrals (status, last_verified_at);
+
+-- Prossimi referral da ricontrollare: prima quelli mai verificati, poi quelli
+-- dei referrer con più inviti (contano per la classifica), poi i più recenti.
+create or replace function referrals_to_reverify(p_limit integer, p_min_age_seconds integer)
+returns table (referred_telegram_id bigint)
+language sql
+stable
+as $$
+    select r.referred_telegram_id
+    from referrals r
+    join users u on u.telegram_id = r.referrer_telegram_id
+    where r.status = 'completed'
+      and (r.last_verified_at is null
+           or r.last_verified_at < now() - make_interval(secs => p_min_age_seconds))
+    order by (r.last_verified_at is null) desc,
+             u.total_invites desc,
+             r.completed_at desc
+    limit p_limit;
+$$;
+
+-- Il completamento avviene subito dopo un controllo dell'iscrizione: vale come verifica.
+create or replace function complete_referral(p_referrer_id bigint, p_referred_id bigint)
+returns text
+language plpgsql
+as $$
+declare
+    v_completed integer;
+begin
+    update referrals
+    set status = 'completed',
+        completed_at = now(),
+        membership_status = 'member',
+        membership_updated_at = now(),
+        last_verified_at = now()
+    where referrer_telegram_id = p_referrer_id
+      and referred_telegram_id = p_referred_id
+      and status = 'pending';
+
+    get diagnostics v_completed = row_count;
+
+    if v_completed = 0 then
+        if exists (
+            select 1 from referrals
+            where referrer_telegram_id = p_referrer_id
+              and referred_telegram_id = p_referred_id
+              and status = 'completed'
+        ) then
+            return 'already_completed';
+        end if;
+        return 'not_found';
+    end if;
+
+    update users
+    set referred_by = p_referrer_id
+    where telegram_id = p_referred_id;
+
+    update users
+    set total_invites = total_invites + v_completed
+    where telegram_id = p_referrer_id;
+
+    return 'completed';
+end;
+$$;
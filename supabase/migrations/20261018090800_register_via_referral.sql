@@ -0,0 +1,53 @@
+-- Registrazione tramite link di invito in un'unica chiamata atomica:
+-- risolve il referrer, crea l'utente e il referral pending.
+--   'registered'          utente creato, restituisce anche il referrer
+--   'already_registered'  l'utente esiste già (nessuna modifica)
+--   'invalid_code'        nessun utente con questo codice referral
+create or replace function register_via_referral(
+    p_telegram_id bigint,
+    p_username text,
+    p_first_name text,
+    p_referral_code text
+)
+returns json
+language plpgsql
+as $$
+declare
+    v_referrer_id bigint;
+    v_referrer_name text;
+    v_inserted integer;
+begin
+    if exists (select 1 from users where telegram_id = p_telegram_id) then
+        return json_build_object('status', 'already_registered');
+    end if;
+
+    select telegram_id, first_name
+    into v_referrer_id, v_referrer_name
+    from users
+    where referral_code = p_referral_code
+    limit 1;
+
+    if not found then
+        return json_build_object('status', 'invalid_code');
+    end if;
+
+    -- Due /start in parallelo: solo il primo inserisce utente e referral
+    insert into users (telegram_id, username, first_name, referral_code)
+    values (p_telegram_id, p_username, p_first_name, 'REF_' || p_telegram_id)
+    on conflict (telegram_id) do nothing;
+
+    get diagnostics v_inserted = row_count;
+
+    if v_inserted = 0 then
+        return json_build_object('status', 'already_registered');
+    end if;
+
+    insert into referrals (referrer_telegram_id, referred_telegram_id, status)
+    values (v_referrer_id, p_telegram_id, 'pending');
+
+    return json_build_object(
+        'status', 'registered',
+        'referrer', json_build_object('telegram_id', v_referrer_id, 'first_name', v_referrer_name)
+    );
+end;
+$$;
@@ -0,0 +1,50 @@
+-- Il completamento di un referral non vale più come verifica recente: senza
+-- ledger chat_member un'uscita successiva non verrebbe vista, e la verifica
+-- finale accetterebbe il referral senza controllo. last_verified_at viene
+-- impostato solo dal ricontrollo a campione.
+create or replace function complete_referral(p_referrer_id bigint, p_referred_id bigint)
+returns text
+language plpgsql
+as $$
+declare
+    v_completed integer;
+begin
+    update referrals
+    set status = 'completed',
+        completed_at = now(),
+        membership_status = 'member',
+        membership_updated_at = now()
+    where referrer_telegram_id = p_referrer_id
+      and referred_telegram_id = p_referred_id
+      and status = 'pending';
+
+    get diagnostics v_completed = row_count;
+
+    if v_completed = 0 then
+        if exists (
+            select 1 from referrals
+            where referrer_telegram_id = p_referrer_id
+              and referred_telegram_id = p_referred_id
+              and status = 'completed'
+        ) then
+            return 'already_completed';
+        end if;
+        return 'not_found';
+    end if;
+
+    update users
+    set referred_by = p_referrer_id
+    where telegram_id = p_referred_id;
+
+    update users
+    set total_invites = total_invites + v_completed
+    where telegram_id = p_referrer_id;
+
+    return 'completed';
+end;
+$$;
+
+-- Date di verifica scritte dal completamento (stesso now() della transazione)
+update referrals
+set last_verified_at = null
+where last_verified_at = completed_at;
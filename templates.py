@@ -0,0 +1,115 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Tastiere che non dipendono dal contest: create una volta sola
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Le mie statistiche", callback_data="show_stats")],
+    [InlineKeyboardButton("🚀 Condividi il mio link", callback_data="share_link")]
+])
+STATS_ONLY_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("📊 Le mie statistiche", callback_data="show_stats")]])
+BACK_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Torna indietro", callback_data="back_to_main")]])
+BACK_TO_MENU_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Menu principale", callback_data="back_to_main")]])
+VERIFY_REFERRAL_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("✅ PARTECIPA", callback_data="verify_subscription")]])
+VERIFY_DIRECT_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("✅ PARTECIPA", callback_data="verify_direct_subscription")]])
+
+RULES_TEXT = "📜 Il regolamento è semplicissimo: vince chi porta più iscritti al canale Telegram di Vivio!\n\n"
+SHARE_CALL_TEXT = "👉 Condividi il tuo link d'invito tramite il tasto qui sotto con tutti i tuoi amici… e che vinca il migliore! 🚀"
+
+JOIN_STEP_TEXT = ("1️⃣ SEGUI IL CANALE TELEGRAM DI VIVIO\n\n"
+                  "(una volta seguito clicca sulla freccia ⬅️ in alto a sinistra per tornare qui)")
+VERIFY_STEP_TEXT = "2️⃣ CLICCA QUI PER ACCEDERE AL CONTEST⬇️"
+INVALID_REFERRAL_TEXT = "❌ Link di invito non valido."
+
+SHARE_INSTRUCTIONS_TEXT = (
+    "📢 **CONDIVIDI IL TUO LINK**\n\n"
+    "Il prossimo messaggio contiene il tuo link di invito già pronto.\n\n"
+    "📱 **Come fare:**\n"
+    "1️⃣ Tieni premuto sul messaggio qui sotto\n"
+    "2️⃣ Seleziona 'Copia'\n"
+    "3️⃣ Incolla su WhatsApp, Instagram, Facebook o ovunque vuoi!"
+)
+
+# Campi del contest usati dai testi: se cambiano i template vengono rigenerati
+TEMPLATE_FIELDS = ('id', 'contest_name', 'prize_description', 'channel_invite_link', 'start_date')
+
+def referral_link(bot_username, referral_code):
+    return f"https://t.me/{bot_username}?start={referral_code}"
+
+def get_full_prize_text(contest):
+    """Restituisce il testo completo dei premi (1°-5° posto)"""
+    prize_text = f"🏆 Premio: {contest['prize_description']}\n"
+    prize_text += f"🥈 2° posto → Bonus 50€\n"
+    prize_text += f"🥉 3° posto → Bonus 25€\n"
+    prize_text += f"4️⃣ 4° posto → Bonus 15€\n"
+    prize_text += f"5️⃣ 5° posto → Bonus 10€"
+    return prize_text
+
+class ContestTemplates:
+    """Testi e tastiere di un contest, pre-renderizzati
+
+    Le parti statiche vengono costruite una volta per contest; i metodi
+    aggiungono solo i campi del singolo utente (nome, inviti, link).
+    """
+
+    def __init__(self, contest):
+        self.signature = tuple(contest.get(field) for field in TEMPLATE_FIELDS)
+        name = contest['contest_name']
+
+        self.prize_text = get_full_prize_text(contest)
+
+        self.welcome_text = (f"🎉 Benvenuto al Contest! 🎉\n\n"
+                             f"✅ Sei ora registrato al contest {name}\n\n"
+                             + RULES_TEXT + self.prize_text + "\n\n" + SHARE_CALL_TEXT)
+        self._welcome_back_head = (f"🎉 Bentornato al Contest {name}! 🎉\n\n"
+                                   + RULES_TEXT + self.prize_text + "\n")
+        self.direct_welcome_text = (f"🎉 Benvenuto al contest {name}!\n\n"
+                                    f"Per partecipare al contest segui questi due passaggi ⬇️")
+        self.completed_menu_text = (f"🏁 Contest {name} terminato\n\n"
+                                    + self.prize_text + "\n\n" + "Grazie per la partecipazione!")
+        self.scheduled_text = self._render_scheduled(contest)
+        self._share_head = f"🎉 Partecipa al contest {name} e vinci {contest['prize_description']}!\n\nUsa il mio link per partecipare:\n"
+
+        invite_link = contest['channel_invite_link']
+        join_button = InlineKeyboardButton("🔗 ISCRIVITI AL CANALE", url=invite_link)
+        self.join_keyboard = InlineKeyboardMarkup([[join_button]])
+        self.join_verify_keyboard = InlineKeyboardMarkup([
+            [join_button],
+            [InlineKeyboardButton("✅ PARTECIPA", callback_data="verify_subscription")]
+        ])
+        self.join_verify_direct_keyboard = InlineKeyboardMarkup([
+            [join_button],
+            [InlineKeyboardButton("✅ PARTECIPA", callback_data="verify_direct_subscription")]
+        ])
+
+    def _render_scheduled(self, contest):
+        if not contest.get('start_date'):
+            return None
+        start_date_str = contest['start_date'].split('T')[0]
+        start_time = contest['start_date'].split('T')[1][:5]
+
+        # Aggiungi 2 ore
+        hour, minute = start_time.split(':')
+        hour = int(hour) + 2
+        start_time = f"{hour:02d}:{minute}"
+
+        message = f"⏰ Contest non ancora iniziato\n\n"
+        message += f"📅 Inizio: {start_date_str} alle {start_time}\n\n"
+        message += self.prize_text + "\n\n"
+        message += f"Torna quando il contest sarà attivo!"
+        return message
+
+    def welcome_back_text(self, total_invites):
+        return (self._welcome_back_head
+                + f"💥 Persone invitate: {total_invites}\n\n" + SHARE_CALL_TEXT)
+
+    def share_text(self, link):
+        return self._share_head + link + "\n\nNon perdere questa opportunità!"
+
+_templates = None
+
+def get_templates(contest):
+    """Template del contest, rigenerati solo quando il contest cambia"""
+    global _templates
+    signature = tuple(contest.get(field) for field in TEMPLATE_FIELDS)
+    if _templates is None or _templates.signature != signature:
+        _templates = ContestTemplates(contest)
+    return _templates
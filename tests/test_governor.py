@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.error import RetryAfter
+from governor import RateGovernor, INTERACTIVE, BULK
+
+class RetryAfterTest(unittest.IsolatedAsyncioTestCase):
+    async def _retry_times(self, endpoint, priority):
+        governor = RateGovernor()
+        calls = []
+
+        async def flooded():
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                raise RetryAfter(1)
+            return True
+
+        data = {'chat_id': 1, 'user_id': 1}
+        self.assertTrue(await governor.process(flooded, (), {}, endpoint, data, priority))
+        return calls[1] - calls[0]
+
+    async def test_non_send_methods_wait_retry_after(self):
+        for endpoint in ('getChatMember', 'editMessageText', 'answerCallbackQuery'):
+            for priority in (INTERACTIVE, BULK):
+                with self.subTest(endpoint=endpoint, priority=priority):
+                    self.assertGreaterEqual(await self._retry_times(endpoint, priority), 0.95)
+
+    async def test_flood_ban_applies_to_other_methods(self):
+        governor = RateGovernor()
+
+        async def flooded():
+            raise RetryAfter(1)
+
+        async def ok():
+            return True
+
+        with self.assertRaises(RetryAfter):
+            await governor.process(flooded, (), {}, 'sendMessage', {'chat_id': 1}, BULK)
+        start = time.monotonic()
+        await governor.process(ok, (), {}, 'getChatMember', {'chat_id': -100, 'user_id': 1}, INTERACTIVE)
+        self.assertGreaterEqual(time.monotonic() - start, 0.95)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,82 +1,262 @@
 import asyncio
 import time
-from database import (get_all_completed_referrals, invalidate_referral, 
-                     recalculate_final_scores, complete_contest_verification,
+from telegram.error import RetryAfter, BadRequest, Forbidden, NetworkError
+from database import (count_referrals_to_verify, iter_referred_to_verify, invalidate_referrals, mark_referrals_verified,
+                     mark_ledger_members_verified, mark_recently_verified_members,
+                     get_verification_counts, recalculate_final_scores, complete_contest_verification,
                      get_top_5_users, get_total_participants, get_current_contest)
+from ratelimit import TokenBucket
+from batching import OutcomeBuffer
+from leaderboard import load_leaderboard
+from membership import membership
+from metrics import FLOOD_WAITS, RETRIES
+
+# Limiti Bot API: ~30 richieste/s globali, restiamo sotto con un margine
+VERIFICATION_RATE = 25
+VERIFICATION_CONCURRENCY = 20
+VERIFICATION_MAX_ATTEMPTS = 5
+# Esiti scritti a blocchi: al massimo un blocco perso in caso di crash
+RESULT_BATCH_SIZE = 200
+RESULT_FLUSH_INTERVAL = 10
+# Intervallo (secondi) tra gli aggiornamenti di avanzamento all'admin
+PROGRESS_INTERVAL = 30
+# Referral 'member' ricontrollati a campione entro questo intervallo non vengono riverificati
+RECENT_VERIFICATION_MAX_AGE = 12 * 3600
+# BadRequest di getChatMember che indicano un utente non presente nel canale; gli altri
+# (chat not found, member list is inaccessible...) dipendono dalla configurazione del bot
+USER_NOT_FOUND_ERRORS = ('user not found', 'participant_id_invalid', 'user_id_invalid')
+
+async def check_membership(bot, channel_id, user_id, bucket, max_attempts=VERIFICATION_MAX_ATTEMPTS):
+    """Controlla se l'utente è nel canale: True/False, None se non verificabile"""
+    for attempt in range(1, max_attempts + 1):
+        await bucket.acquire()
+        try:
+            # Sempre riletto da Telegram: la verifica finale non si fida della cache
+            return await membership.is_member(bot, channel_id, user_id, use_cache=False)
+        except RetryAfter as e:
+            # Flood control: ferma tutti i worker per il tempo indicato da Telegram
+            print(f"⏳ RetryAfter {e.retry_after}s durante verifica {user_id}")
+            FLOOD_WAITS.inc(operation='verification')
+            bucket.pause(e.retry_after)
+        except BadRequest as e:
+            if any(error in e.message.lower() for error in USER_NOT_FOUND_ERRORS):
+                # Utente sconosciuto al canale (mai entrato o account eliminato)
+                print(f"⚠️ Utente {user_id} non trovato nel canale: {e}")
+                return False
+            # Canale errato o bot non admin: non è un'uscita dell'utente
+            print(f"❌ Impossibile verificare {user_id} nel canale {channel_id}: {e}")
+            return None
+        except Forbidden as e:
+            print(f"❌ Bot senza accesso al canale {channel_id}: {e}")
+            return None
+        except NetworkError as e:
+            # Errore transitorio (timeout, rete): riprova con backoff esponenziale
+            print(f"⚠️ Errore transitorio verifica {user_id} (tentativo {attempt}): {e}")
+            RETRIES.inc(operation='verification')
+            await asyncio.sleep(min(2 ** attempt, 30))
+    
+    return None
+
+async def verify_memberships(bot, channel_id, user_ids, on_result=None,
+                             rate=VERIFICATION_RATE, concurrency=VERIFICATION_CONCURRENCY):
+    """Verifica in parallelo l'iscrizione al canale di più utenti
+    
+    `user_ids` è un async iterable consumato man mano (memoria costante);
+    tutte le richieste passano dallo stesso token bucket. `on_result(user_id,
+    is_member)` viene awaited per ogni esito. Restituisce i conteggi
+    {'member', 'left', 'unverified'}.
+    """
+    bucket = TokenBucket(rate)
+    queue = asyncio.Queue(maxsize=concurrency * 4)
+    counts = {'member': 0, 'left': 0, 'unverified': 0}
+    
+    async def producer():
+        try:
+            async for user_id in user_ids:
+                await queue.put(user_id)
+        finally:
+            for _ in range(concurrency):
+                await queue.put(None)
+    
+    async def worker():
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            is_member = await check_membership(bot, channel_id, user_id, bucket)
+            counts['member' if is_member else 'unverified' if is_member is None else 'left'] += 1
+            if on_result:
+                try:
+                    await on_result(user_id, is_member)
+                except Exception as e:
+                    print(f"❌ Errore gestione esito verifica {user_id}: {e}")
+    
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    producer_task = asyncio.create_task(producer())
+    try:
+        await asyncio.gather(producer_task, *workers)
+    finally:
+        producer_task.cancel()
+        for task in workers:
+            task.cancel()
+    
+    return counts
+
+# Evita due verifiche finali in parallelo (comando admin + ripresa all'avvio)
+_verification_running = False
+
+async def write_verification_results(is_member, referred_ids):
+    """Salva un blocco di esiti: è il checkpoint per riprendere dopo un riavvio"""
+    if is_member:
+        ok = await mark_referrals_verified(referred_ids)
+    else:
+        ok = await invalidate_referrals(referred_ids)
+    if ok:
+        print(f"💾 {'Verificati' if is_member else 'Invalidati'}: {len(referred_ids)} referral")
+    return ok
+
+async def ledger_is_live(bot, channel_id):
+    """Il ledger iscrizioni è affidabile solo se il bot riceve gli update chat_member (admin del canale)"""
+    try:
+        member = await bot.get_chat_member(channel_id, bot.id)
+        return member.status == 'administrator'
+    except Exception as e:
+        print(f"⚠️ Impossibile verificare i permessi del bot nel canale: {e}")
+        return False
+
+async def resume_final_verification(bot, admin_id):
+    """Riprende una verifica finale interrotta (es. riavvio durante la verifica)"""
+    contest = await get_current_contest()
+    if not contest or contest['status'] != 'verification_in_progress':
+        return False
+    
+    print("♻️ Verifica finale interrotta trovata - ripresa...")
+    await bot.send_message(admin_id, "♻️ Ripresa della verifica finale interrotta...")
+    return await run_final_verification(bot, admin_id)
 
 async def run_final_verification(bot, admin_id):
-    """Esegue la verifica finale completa del contest"""
+    """Esegue (o riprende) la verifica finale completa del contest"""
+    global _verification_running
     
+    if _verification_running:
+        print("ℹ️ Verifica finale già in corso")
+        return False
+    
+    _verification_running = True
+    try:
+        return await _run_final_verification(bot, admin_id)
+    finally:
+        _verification_running = False
+
+async def _run_final_verification(bot, admin_id):
     print("🔍 Inizio verifica finale...")
-    contest = get_current_contest()
+    contest = await get_current_contest()
     
     if not contest:
         print("❌ Nessun contest attivo")
         return False
     
-    # Ottieni tutti i referral da verificare
-    referrals = get_all_completed_referrals()
-    total_referrals = len(referrals)
+    # Referral confermati dal ledger chat_member: validi senza chiamate Bot API
+    if await ledger_is_live(bot, contest['channel_id']):
+        trusted = await mark_ledger_members_verified()
+        if trusted is None:
+            await bot.send_message(admin_id, "❌ Errore lettura ledger iscrizioni. Verifica finale sospesa, verrà ripresa al prossimo avvio.")
+            return False
+        if trusted:
+            print(f"📒 {trusted} referral confermati dal ledger iscrizioni")
+    else:
+        print("⚠️ Bot non admin del canale: ledger non affidabile")
+    
+    # Referral confermati di recente dal ricontrollo a campione durante il contest
+    recent = await mark_recently_verified_members(RECENT_VERIFICATION_MAX_AGE)
+    if recent is None:
+        await bot.send_message(admin_id, "❌ Errore lettura ricontrolli recenti. Verifica finale sospesa, verrà ripresa al prossimo avvio.")
+        return False
+    if recent:
+        print(f"🔁 {recent} referral confermati da ricontrolli recenti")
+    
+    # Referral ancora da controllare (incerti o senza ledger): quelli con esito già salvato vengono saltati
+    total_referrals = await count_referrals_to_verify()
+    if total_referrals is None:
+        await bot.send_message(admin_id, "❌ Errore lettura referral. Verifica finale sospesa, verrà ripresa al prossimo avvio.")
+        return False
     
     if total_referrals == 0:
         print("ℹ️ Nessun referral da verificare")
-        await complete_final_verification(bot, admin_id, 0, 0)
-        return True
+        return await finish_final_verification(bot, admin_id, 0)
     
     print(f"📊 Verifica di {total_referrals} referral in corso...")
     
     # Notifica admin inizio verifica
     await bot.send_message(admin_id, f"🔍 Verifica finale avviata\n\nReferral da controllare: {total_referrals}")
     
-    verified_count = 0
-    invalidated_count = 0
+    unverified_count = 0
+    checked_count = 0
+    last_progress = time.monotonic()
+    results = OutcomeBuffer(write_verification_results, RESULT_BATCH_SIZE, RESULT_FLUSH_INTERVAL)
     
-    # Verifica ogni referral con rate limiting
-    for i, referral in enumerate(referrals):
-        try:
-            # Controlla se utente è ancora nel canale
-            member = await bot.get_chat_member(contest['channel_id'], referral['referred_telegram_id'])
-            
-            if member.status in ['member', 'administrator', 'creator']:
-                # Utente ancora nel canale - referral valido
-                verified_count += 1
-            else:
-                # Utente non nel canale - invalida referral
-                invalidate_referral(referral['referrer_telegram_id'], referral['referred_telegram_id'])
-                invalidated_count += 1
-            
-            # Progress update ogni 50 verifiche
-            if (i + 1) % 50 == 0:
-                progress = f"Progress: {i + 1}/{total_referrals} verificati"
-                await bot.send_message(admin_id, f"⏳ {progress}")
-                print(f"⏳ {progress}")
-            
-            # Rate limiting: pausa ogni 25 verifiche
-            if (i + 1) % 25 == 0:
-                await asyncio.sleep(1)  # Pausa 1 secondo ogni 25 verifiche
-                
-        except Exception as e:
-            print(f"❌ Errore verifica utente {referral['referred_telegram_id']}: {e}")
-            # In caso di errore, consideriamo il referral come non valido
-            invalidate_referral(referral['referrer_telegram_id'], referral['referred_telegram_id'])
-            invalidated_count += 1
-    
-    # Completa la verifica
-    await complete_final_verification(bot, admin_id, verified_count, invalidated_count)
-    return True
+    async def on_result(user_id, is_member):
+        nonlocal unverified_count, checked_count, last_progress
+        checked_count += 1
+        
+        if is_member is None:
+            # Errori ripetuti: non lo consideriamo invalido (resta da verificare)
+            unverified_count += 1
+        else:
+            # Valido se ancora nel canale, altrimenti invalidato
+            await results.add(user_id, is_member)
+        
+        # Progress update periodico
+        if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            progress = f"Progress: {checked_count}/{total_referrals} verificati"
+            await bot.send_message(admin_id, f"⏳ {progress}")
+            print(f"⏳ {progress}")
+    
+    try:
+        # I referral vengono letti a pagine mentre i worker verificano
+        await verify_memberships(bot, contest['channel_id'], iter_referred_to_verify(), on_result=on_result)
+    except Exception as e:
+        print(f"❌ Errore lettura referral durante la verifica: {e}")
+        await results.flush()
+        await bot.send_message(admin_id, "❌ Errore lettura referral. Verifica finale sospesa, verrà ripresa al prossimo avvio.")
+        return False
+    
+    # Scrive gli ultimi esiti rimasti nel buffer prima del ricalcolo
+    if not await results.flush():
+        await bot.send_message(admin_id, "❌ Errore nel salvataggio degli esiti. Punteggi non ricalcolati.")
+        return False
+    
+    return await finish_final_verification(bot, admin_id, unverified_count)
 
-async def complete_final_verification(bot, admin_id, valid_count, invalid_count):
-    """Completa il processo di verifica e notifica admin"""
+async def finish_final_verification(bot, admin_id, unverified_count):
+    """Conta gli esiti salvati (anche di esecuzioni precedenti) e chiude il contest"""
+    valid_count, invalid_count = await get_verification_counts()
+    if valid_count is None:
+        await bot.send_message(admin_id, "❌ Errore conteggio esiti verifica. Contest non completato.")
+        return False
+    
+    return await complete_final_verification(bot, admin_id, valid_count, invalid_count, unverified_count)
+
+async def complete_final_verification(bot, admin_id, valid_count, invalid_count, unverified_count=0):
+    """Completa il processo di verifica e notifica admin; False se il contest non è stato chiuso"""
     
     print("📊 Ricalcolo punteggi finali...")
-    recalculate_final_scores()
+    if not await recalculate_final_scores():
+        # Il contest resta in verification_in_progress: i punteggi live non tengono conto delle invalidazioni
+        await bot.send_message(admin_id, "❌ Errore ricalcolo punteggi finali. Contest non completato, verrà ripreso al prossimo avvio.")
+        return False
+    # Classifica in memoria allineata ai punteggi finali
+    await load_leaderboard()
     
     print("✅ Completamento contest...")
-    complete_contest_verification()
+    if not await complete_contest_verification():
+        await bot.send_message(admin_id, "❌ Errore completamento contest. Verifica finale verrà ripresa al prossimo avvio.")
+        return False
     
     # Ottieni risultati finali
-    top_5 = get_top_5_users()
-    total_participants = get_total_participants()
+    top_5 = await get_top_5_users()
+    total_participants = await get_total_participants()
     
     # Crea messaggio per admin
     message = "🏆 CONTEST TERMINATO - TOP 5\n\n"
@@ -88,9 +268,14 @@ async def complete_final_verification(bot, admin_id, valid_count, invalid_count)
     message += f"👥 Totale partecipanti: {total_participants:,}\n"
     message += f"✅ Referral validi: {valid_count:,}\n"
     message += f"❌ Referral invalidati: {invalid_count:,}\n"
-    message += f"📈 Tasso validità: {(valid_count/(valid_count+invalid_count)*100):.1f}%\n"
+    if unverified_count:
+        message += f"⚠️ Non verificabili (errori ripetuti): {unverified_count:,}\n"
+    checked = valid_count + invalid_count
+    validity_rate = (valid_count / checked * 100) if checked > 0 else 0
+    message += f"📈 Tasso validità: {validity_rate:.1f}%\n"
     
     message += f"\nUsa /admin_announce_results per sbloccare i risultati per tutti gli utenti."
     
     await bot.send_message(admin_id, message)
-    print("✅ Verifica finale completata!")
\ No newline at end of file
+    print("✅ Verifica finale completata!")
+    return True
\ No newline at end of file
@@ -0,0 +1,102 @@
+import json
+import httpx
+import tornado.web
+from telegram import Update
+from metrics import render_metrics
+
+# Percorso su cui Telegram consegna gli update in modalità webhook
+WEBHOOK_PATH = "/telegram"
+# Header degli update inoltrati da un'altra replica (non vanno reinoltrati)
+FORWARDED_HEADER = "X-Shard-Forwarded"
+SHARD_FORWARD_TIMEOUT = 5.0
+
+# Client HTTP per l'inoltro tra repliche, creato al primo utilizzo
+_forward_client = None
+
+def shard_for_update(update, shard_count):
+    """Replica responsabile dell'update: tutti gli update di un utente vanno alla stessa"""
+    user = update.effective_user
+    if shard_count <= 1 or user is None:
+        return None
+    return user.id % shard_count
+
+async def forward_update(shard_url, body, secret_token):
+    """Inoltra l'update grezzo alla replica proprietaria; True se l'ha accettato"""
+    global _forward_client
+    if _forward_client is None:
+        _forward_client = httpx.AsyncClient(timeout=SHARD_FORWARD_TIMEOUT)
+    try:
+        response = await _forward_client.post(
+            shard_url + WEBHOOK_PATH,
+            content=body,
+            headers={
+                "Content-Type": "application/json",
+                "X-Telegram-Bot-Api-Secret-Token": secret_token,
+                FORWARDED_HEADER: "1"
+            }
+        )
+        return response.status_code == 200
+    except httpx.HTTPError as e:
+        print(f"⚠️ Inoltro update a {shard_url} fallito: {e}")
+        return False
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """Riceve gli update di Telegram e li mette in coda all'Application"""
+
+    def initialize(self, bot_application, secret_token, shard_urls, shard_index):
+        self.bot_application = bot_application
+        self.secret_token = secret_token
+        self.shard_urls = shard_urls
+        self.shard_index = shard_index
+
+    async def post(self):
+        # Solo Telegram conosce il secret token impostato con set_webhook
+        if self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret_token:
+            self.set_status(403)
+            return
+
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+
+        update = Update.de_json(data, self.bot_application.bot)
+        
+        # Sharding per user_id: se l'utente appartiene a un'altra replica lo inoltriamo.
+        # Se l'inoltro fallisce l'update viene gestito qui per non perderlo.
+        owner = shard_for_update(update, len(self.shard_urls))
+        if (owner is not None and owner != self.shard_index
+                and not self.request.headers.get(FORWARDED_HEADER)):
+            if await forward_update(self.shard_urls[owner], self.request.body, self.secret_token):
+                self.set_status(200)
+                return
+        
+        await self.bot_application.update_queue.put(update)
+        self.set_status(200)
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("ok")
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Metriche di latenza e contatori in formato Prometheus"""
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render_metrics())
+
+def make_web_app(application, secret_token, shard_urls=(), shard_index=0, webhook=True):
+    """Server HTTP del bot: webhook Telegram (con sharding opzionale), health check e metriche"""
+    routes = [
+        (r"/health", HealthHandler),
+        (r"/metrics", MetricsHandler),
+    ]
+    if webhook:
+        routes.append((WEBHOOK_PATH, WebhookHandler, {
+            'bot_application': application,
+            'secret_token': secret_token,
+            'shard_urls': list(shard_urls),
+            'shard_index': shard_index
+        }))
+    return tornado.web.Application(routes)